@@ -0,0 +1,32 @@
+'''
+Microbenchmark for the magic key transformer.
+
+Checks that the fast, cached path produces the same paths as the generic
+parser and then times both. Run it from the repository root. ::
+
+    python benchmarks/magic.py
+'''
+import os, sys, timeit, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from vlermv.transformers import magic
+
+KEYS = [
+    ('abc',), ('abc', 3), 'favorite color', 12345, (None, 'x', 8),
+    'left/middle/right', 'http://thomaslevine.com/!/about?a=b#lala',
+    ('http://thomaslevine.com', 'foo/bar/baz', 'a b'),
+    ('.', '..', '.tmp'), datetime.date(2014, 2, 5), ['foo', 'bar'],
+]
+
+def main(number = 20000):
+    for key in KEYS:
+        assert magic.to_path(key) == magic._to_path_generic(key), key
+
+    for name, func in [('generic', magic._to_path_generic), ('to_path', magic.to_path)]:
+        seconds = timeit.timeit(lambda: [func(key) for key in KEYS], number = number)
+        per_key = 1e6 * seconds / (number * len(KEYS))
+        sys.stdout.write('%-8s %6.2f us per key\n' % (name, per_key))
+
+if __name__ == '__main__':
+    main()
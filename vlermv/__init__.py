@@ -1,6 +1,21 @@
 from ._fs import Vlermv
-from ._s3 import S3Vlermv
+from ._bloom import BloomFilter
 from . import serializers, transformers
 
 # For backwards compatibility
 cache = Vlermv.memoize
+
+# Optional backends are imported on first access so that
+# "import vlermv" stays fast and doesn't import boto.
+_lazy = {
+    'S3Vlermv': '._s3',
+    'AsyncS3Vlermv': '._async_s3',
+}
+
+def __getattr__(name):
+    if name in _lazy:
+        from importlib import import_module
+        value = getattr(import_module(_lazy[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
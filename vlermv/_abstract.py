@@ -1,14 +1,54 @@
-import os, re
+import os, re, io, importlib, threading, time, json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from ._exceptions import PermissionError
 from .serializers import pickle
 from .transformers import magic
-from ._util import safe_path
+from ._util import safe_path, read_ahead
+from ._bloom import BloomFilter
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+def _timed(func, *args, **kwargs):
+    ':returns: The result of the function and how many seconds it took'
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def _compact(error):
+    '''
+    Copy an exception with only its type and args, leaving out its
+    traceback, context, and attributes, so that it pickles small.
+    '''
+    try:
+        return error.__class__(*error.args)
+    except Exception:
+        # The constructor doesn't take its own args, so save it as it is.
+        return error
+
+class _by_name:
+    '''
+    A picklable reference to a memoized function, for process pools.
+    The function's own name refers to the vlermv that memoizes it,
+    so the function can't be pickled by name directly.
+    '''
+    def __init__(self, func):
+        self.module = func.__module__
+        self.qualname = func.__qualname__
+        if '<' in self.qualname:
+            raise ValueError('%s must be defined at the top level of a module.' % self.qualname)
+
+    def __call__(self, *args):
+        func = importlib.import_module(self.module)
+        for name in self.qualname.split('.'):
+            func = getattr(func, name)
+        if isinstance(func, AbstractVlermv):
+            func = func.func
+        return func(*args)
+
 class AbstractVlermv:
     '''
     A :py:class:`dict` API to various things
@@ -36,6 +76,15 @@ class AbstractVlermv:
 
         Third, you are more likely to use the ``cache_exceptions`` keyword
         argument; see :py:class:`~vlermv.Vlermv` for documentation on that.
+
+        Keyword arguments to the function are not part of the key unless you
+        pass ``key_kwargs = True``. This is most useful with the
+        :py:data:`~vlermv.transformers.content_hash` transformer. ::
+
+            @Vlermv.memoize('~/.fits', key_kwargs = True,
+                            key_transformer = vlermv.transformers.content_hash)
+            def fit(data, alpha = 0.1):
+                ...
         '''
         def decorator(func):
             if len(args) == 0:
@@ -50,14 +99,58 @@ class AbstractVlermv:
             return v
         return decorator
 
+    @classmethod
+    def memoize_batch(Class, *args, **kwargs):
+        '''
+        Memoize a function that takes a batch of inputs (a list or an array)
+        and returns a sequence of results, one for each input. ::
+
+            @Vlermv.memoize_batch('~/.scores')
+            def score(texts):
+                return model.predict(texts)
+
+            scores = score(['a', 'b', 'c'])
+
+        The function is called once, with only the inputs that aren't saved
+        yet, and the results are saved separately for each input,
+        with the same keys as if the function had been memoized with
+        :py:meth:`memoize` and called on one input at a time.
+        The memoized function returns a list of the results in the order
+        of the inputs.
+
+        Inputs with a ``tolist`` method, like NumPy arrays, are converted
+        to lists to make the keys, and the function gets the inputs that
+        weren't saved as ``inputs[positions]``, so it still gets an array.
+        If the function raises an exception, nothing is saved,
+        even if ``cache_exceptions`` is True.
+        '''
+        def decorator(func):
+            v = Class.memoize(*args, **kwargs)(func)
+            v.batch = True
+            return v
+        return decorator
+
     serializer = pickle
     key_transformer = magic
     appendable = True
     mutable = True
     tempdir = '.tmp'
     cache_exceptions = False
+    key_kwargs = False
     extension = ''
     base_directory = ''
+    bloom_filter = None
+    lookup_threads = 4
+    ttl = None
+    error_ttl = None
+    stale_while_revalidate = 0
+    record_cost = False
+    skip_unchanged = False
+    #: Directory, relative to base_directory, that records how long values
+    #: took to compute, in files with the same paths as the values
+    cost_directory = '.vlermv-costs'
+    #: Is func a batch function? (See :py:meth:`memoize_batch`.)
+    batch = False
 
     def __init__(self, **kwargs):
         '''
@@ -80,24 +173,172 @@ class AbstractVlermv:
             (Set this to False to ensure that the decorated function is never
             run and that the all results are cached; this is useful for reviewing
             old data in a read-only mode.)
-        :param bool cache_exceptions: If the decorated function raises
+        :param cache_exceptions: If the decorated function raises
             an exception, should the failure and exception be cached?
-            The exception is raised either way.
+            True to cache all exceptions, or an exception class or tuple of
+            them to cache only those. The exception is raised either way.
+            Only the exception's type and args are saved, not its
+            traceback or attributes.
+        :param bool key_kwargs: Should keyword arguments to the decorated
+            function be part of the key? If so, the key is
+            ``(args, tuple(sorted(kwargs.items())))`` rather than ``args``.
+        :param bloom_filter: A :py:class:`~vlermv.BloomFilter`, or the
+            filename for one, for answering lookups of keys that were never
+            set without asking the backend; see :py:meth:`rebuild_bloom_filter`.
+        :param float ttl: Seconds after a value is saved during which the
+            memoized function uses it; after that, the function is run again.
+            By default, saved values are used forever.
+        :param float stale_while_revalidate: Seconds past ttl during which
+            the memoized function still returns the saved value immediately
+            but recomputes it in a background thread, at most one per key
+            at a time. Older values are recomputed before returning.
+        :param float error_ttl: Seconds after a failure is saved (with
+            ``cache_exceptions``) during which the memoized function raises
+            the saved exception; after that, the function is run again.
+            Defaults to ttl. Failures are never returned stale.
+        :param bool record_cost: Should memoized functions record how long
+            each value took to compute, for :py:meth:`evict`? This is saved
+            in a file with the same path as the value, under cost_directory.
+        :param bool skip_unchanged: When setting a value, compare a hash of
+            its serialized form with that of the stored value, and don't
+            write it if they are the same. This saves writes when values are
+            recomputed identically, at the cost of hashing each value and
+            checking the stored one. With a ttl or error_ttl, Vlermv still
+            updates the modification time of skipped files, and the S3
+            vlermvs write every value.
+        :param int lookup_threads: Number of threads for looking up keys
+            in :py:meth:`map` and in functions memoized with
+            :py:meth:`memoize_batch`
         :raises TypeError: If cache_exceptions is True but the serializer
             can't cache exceptions
         '''
         for key in ['serializer', 'appendable', 'mutable', 'base_directory',
-                    'key_transformer', 'cache_exceptions', 'extension']:
+                    'key_transformer', 'cache_exceptions', 'extension',
+                    'key_kwargs', 'bloom_filter', 'lookup_threads',
+                    'ttl', 'error_ttl', 'stale_while_revalidate', 'record_cost',
+                    'skip_unchanged']:
             setattr(self, key, kwargs.get(key, getattr(self.__class__, key)))
 
+        if isinstance(self.bloom_filter, str):
+            self.bloom_filter = BloomFilter(os.path.expanduser(self.bloom_filter))
+
         if self.cache_exceptions and not getattr(self.serializer, 'cache_exceptions', True):
             msg = 'Serializer %s cannot cache exceptions.'
             raise TypeError(msg % repr(self.serializer))
 
         self.binary_mode = getattr(self.serializer, 'binary_mode', False)
         self.func = None
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
 
     def __call__(self, *args, **kwargs):
+        self._check_func()
+        if self.batch:
+            return self._call_batch(*args, **kwargs)
+        index = self._memo_key(args, kwargs)
+        hit, output, age = self._try_lookup_aged(index)
+        ttl = self._ttl(output) if hit else None
+        if hit and ttl != None and age >= ttl:
+            if age < ttl + self.stale_while_revalidate and not self._failed(output):
+                self._refresh(index, args, kwargs)
+            else:
+                hit = False
+        if not hit:
+            output, seconds = self._output(args, kwargs, lambda: _timed(self.func, *args, **kwargs))
+            self._save(index, output, seconds)
+        return self._result(output)
+
+    def map(self, *iterables, workers = None, executor = 'thread'):
+        '''
+        Call the memoized function on each element of the iterables, like
+        :py:func:`map`, computing only the values that aren't saved yet. ::
+
+            @vlermv.cache()
+            def simulate(seed):
+                ...
+
+            results = list(simulate.map(range(1000), workers = 8, executor = 'process'))
+
+        The keys are looked up in background threads, the missing values are
+        computed in ``workers`` threads or processes, and this process saves
+        them. Results are yielded in the order of the inputs, each as soon
+        as it and the ones before it are ready. At most twice ``workers``
+        values are computed or held waiting for earlier ones at once, so the
+        iterables are consumed only as fast as the results are.
+
+        :param int workers: Number of threads or processes for computing values
+        :param str executor: ``'thread'`` or ``'process'``. With processes,
+            the function must be defined at the top level of a module,
+            and its arguments and results must be picklable.
+        '''
+        self._check_func()
+        if executor == 'thread':
+            pool = ThreadPoolExecutor(max_workers = workers)
+            func = self.func
+        elif executor == 'process':
+            pool = ProcessPoolExecutor(max_workers = workers)
+            func = _by_name(self.func)
+        else:
+            raise ValueError('executor must be "thread" or "process", not %s.' % repr(executor))
+
+        window = 2 * (workers or os.cpu_count() or 1)
+        # (index, args, output, future) in the order of the inputs
+        pending = deque()
+        def ready(limit):
+            'Yield the results that are ready, waiting while more than limit are pending.'
+            while pending:
+                index, args, output, future = pending[0]
+                if future != None:
+                    if len(pending) <= limit and not future.done():
+                        return
+                    output, seconds = self._output(args, {}, future.result)
+                    self._save(index, output, seconds)
+                pending.popleft()
+                yield self._result(output)
+
+        try:
+            indices = (self._memo_key(args, {}) for args in zip(*iterables))
+            for index, (hit, output) in read_ahead(self._try_lookup, indices, self.lookup_threads):
+                args = index[0] if self.key_kwargs else index
+                future = None if hit else pool.submit(_timed, func, *args)
+                pending.append((index, args, output, future))
+                yield from ready(window - 1)
+            yield from ready(0)
+        finally:
+            pool.shutdown(wait = True, cancel_futures = True)
+
+    def _call_batch(self, inputs, **kwargs):
+        array = hasattr(inputs, 'tolist')
+        items = inputs.tolist() if array else list(inputs)
+        indices = [self._memo_key((item,), kwargs) for item in items]
+        outputs = [None] * len(items)
+
+        # filename -> positions of the inputs, so repeated inputs are computed once
+        misses = {}
+        lookups = read_ahead(lambda i: self._try_lookup(indices[i]), range(len(items)), self.lookup_threads)
+        for i, (hit, output) in lookups:
+            if hit:
+                outputs[i] = self._result(output)
+            else:
+                misses.setdefault(self.filename(indices[i]), []).append(i)
+        if not misses:
+            return outputs
+
+        firsts = [positions[0] for positions in misses.values()]
+        results, seconds = _timed(self.func, inputs[firsts] if array else [items[i] for i in firsts], **kwargs)
+        results = list(results)
+        if len(results) != len(firsts):
+            msg = '%s returned %d results for %d inputs.'
+            raise ValueError(msg % (getattr(self.func, '__name__', self.func), len(results), len(firsts)))
+        for positions, result in zip(misses.values(), results):
+            # Each value gets an equal share of the batch's time.
+            self._save(indices[positions[0]], (None, result) if self.cache_exceptions else result,
+                       seconds / len(firsts))
+            for i in positions:
+                outputs[i] = result
+        return outputs
+
+    def _check_func(self):
         if self.func == None:
             msg = 'Set %s.func to something if you want to call %s.'
             raise NotImplementedError(msg % (self, self))
@@ -105,26 +346,114 @@ class AbstractVlermv:
         if not hasattr(self.func, '__call__'):
             raise AttributeError('%s.func must be callable.' % self.__class__.__name__)
 
-        if args in self:
-            output = self[args]
-        else:
+    def _try_lookup(self, index):
+        ':returns: Whether the key was found (and isn\'t older than ttl), and its value if so'
+        hit, output, age = self._try_lookup_aged(index)
+        ttl = self._ttl(output) if hit else None
+        return hit and (ttl == None or age < ttl), output
+
+    def _failed(self, output):
+        'Is this saved value a cached exception?'
+        return bool(self.cache_exceptions) and isinstance(output, (tuple, list)) \
+            and len(output) == 2 and output[0] != None
+
+    def _ttl(self, output):
+        ':returns: The ttl for a saved value, which depends on whether it is a failure'
+        if self.error_ttl != None and self._failed(output):
+            return self.error_ttl
+        return self.ttl
+
+    def _caches(self, error):
+        'Should this exception be cached?'
+        if self.cache_exceptions is True:
+            return True
+        return bool(self.cache_exceptions) and isinstance(error, self.cache_exceptions)
+
+    def _try_lookup_aged(self, index):
+        '''
+        :returns: Whether the key was found, its value, and (if there is
+            a ttl) the age of the value in seconds
+        '''
+        try:
+            if self.ttl == None and self.error_ttl == None:
+                return True, self._lookup(index), None
+            output, mtime = self._lookup_dated(index)
+        except KeyError:
+            return False, None, None
+        return True, output, time.time() - mtime
+
+    def _lookup_dated(self, index):
+        '''
+        Get the value for a key and the time when it was saved, in seconds
+        since the epoch, raising :py:class:`KeyError` if there is none.
+        '''
+        return self._lookup(index), self._mtime(index)
+
+    def _mtime(self, index):
+        raise NotImplementedError
+
+    def _refresh(self, index, args, kwargs):
+        '''
+        Recompute a stale value in a background thread,
+        unless it is already being recomputed.
+        '''
+        filename = self.filename(index)
+        with self._refresh_lock:
+            if filename in self._refreshing:
+                return
+            self._refreshing.add(filename)
+
+        def refresh():
             try:
-                result = self.func(*args, **kwargs)
-            except Exception as error:
-                signature = self.__class__.__name__, getattr(self.func, '__name__', str(self.func)), args, kwargs
-                msg = 'Exception in %s calling this memoized function:\n%s(*%s, *%s)' % signature
-                logger.error(msg, exc_info = False)
-                if self.cache_exceptions:
-                    output = error, None
-                else:
-                    raise error
+                output, seconds = self._output(args, kwargs, lambda: _timed(self.func, *args, **kwargs))
+                if self._failed(output):
+                    # A cached exception would replace the good value.
+                    raise output[0]
+                self._save(index, output, seconds)
+            except Exception:
+                logger.warning('Could not refresh %s; keeping the stale value.', filename)
+            finally:
+                with self._refresh_lock:
+                    self._refreshing.discard(filename)
+        threading.Thread(target = refresh, daemon = True).start()
+
+    def _output(self, args, kwargs, call):
+        '''
+        Get the result of the function and its duration from call,
+        and make the value to save; if the function raised an exception,
+        raise it too unless exceptions are cached.
+
+        :returns: The value to save, and the seconds that the function took
+            (None if it raised an exception)
+        '''
+        try:
+            result, seconds = call()
+        except Exception as error:
+            signature = self.__class__.__name__, getattr(self.func, '__name__', str(self.func)), args, kwargs
+            msg = 'Exception in %s calling this memoized function:\n%s(*%s, *%s)' % signature
+            logger.error(msg, exc_info = False)
+            if self._caches(error):
+                return (error, None), None
             else:
-                if self.cache_exceptions:
-                    output = None, result
-                else:
-                    output = result
-            self[args] = output
+                raise error
+        else:
+            if self.cache_exceptions:
+                return (None, result), seconds
+            else:
+                return result, seconds
 
+    def _save(self, index, output, seconds = None):
+        'Save a value from the memoized function, and how long it took.'
+        if self._failed(output):
+            self[index] = _compact(output[0]), None
+        else:
+            self[index] = output
+        if self.record_cost and seconds != None:
+            cost = {'seconds': seconds, 'inflation': self._read_inflation()}
+            self._write_sidecar(self._cost_filename(self.filename(index)), json.dumps(cost))
+
+    def _result(self, output):
+        'Get the function\'s result from a saved value, or raise its exception.'
         if self.cache_exceptions:
             if len(output) != 2:
                 msg = '''Deserializer returned %d elements,
@@ -139,10 +468,106 @@ There's probably a problem with the serializer.''')
 
             if error:
                 raise error
+            return result
+        else:
+            return output
+
+    def _memo_key(self, args, kwargs):
+        if self.key_kwargs:
+            return args, tuple(sorted(kwargs.items()))
         else:
-            result = output
+            return args
+
+    def _sidecar(self, index):
+        '''
+        If the key_transformer keeps sidecar files, get the sidecar's
+        suffix and contents for a particular key; otherwise, None.
+        '''
+        if getattr(self.key_transformer, 'sidecar', False):
+            return self.key_transformer.sidecar_suffix, \
+                   self.key_transformer.describe(index)
+
+    def _sidecar_suffixes(self):
+        'Suffixes of the sidecar files that may be next to each value'
+        if getattr(self.key_transformer, 'sidecar', False):
+            return [self.key_transformer.sidecar_suffix]
+        return []
+
+    def _is_sidecar(self, filename):
+        return any(filename.endswith(suffix) for suffix in self._sidecar_suffixes())
+
+    def _cost_filename(self, filename):
+        'Where the cost of the value in filename is recorded'
+        return self._record_filename(self.cost_directory, filename)
+
+    def _record_filename(self, directory, filename):
+        'The path of filename, relative to base_directory, under directory'
+        relative = filename[len(self.base_directory):].lstrip('/')
+        return os.path.join(self.base_directory, directory, relative)
+
+    def _write_sidecar(self, filename, text):
+        raise NotImplementedError
 
-        return result
+    def _read_sidecar(self, filename):
+        ':returns: The contents of a sidecar (or similar) file, or None if there is none'
+        raise NotImplementedError
+
+    def _sizes(self):
+        'Iterate over ``(filename, size in bytes)`` for each value.'
+        raise NotImplementedError
+
+    def _delete_filenames(self, filenames):
+        'Delete values and their sidecars by filename; missing ones are skipped.'
+        raise NotImplementedError
+
+    def _inflation_filename(self):
+        raise NotImplementedError
+
+    def _read_inflation(self):
+        text = self._read_sidecar(self._inflation_filename())
+        return 0.0 if text == None else float(text)
+
+    def evict(self, budget):
+        '''
+        Delete values until the rest take at most budget bytes, keeping
+        the ones that took longest to compute per byte. This is
+        GreedyDual-Size: each value's priority is the "inflation" when it
+        was saved plus its compute time divided by its size. Values with the
+        lowest priorities are deleted, and the inflation then becomes the
+        highest priority that was deleted, so values that were saved long ago
+        eventually get deleted even if they were expensive.
+
+        Compute times come from memoized functions with ``record_cost``;
+        values without them count as free to recompute. Accessing a value
+        doesn't change its priority.
+
+        :param int budget: Maximum total size of the values, in bytes
+        :returns: The number of values deleted
+        '''
+        self._check_delitem()
+        sizes = list(self._sizes())
+        total = sum(size for _, size in sizes)
+        if total <= budget:
+            return 0
+
+        inflation = self._read_inflation()
+        size_of = dict(sizes)
+        def priority(filename):
+            text = self._read_sidecar(self._cost_filename(filename))
+            cost = json.loads(text) if text else {}
+            return cost.get('inflation', inflation) + cost.get('seconds', 0) / max(size_of[filename], 1)
+        priorities = read_ahead(priority, size_of, self.lookup_threads)
+
+        evicted = []
+        for filename, h in sorted(priorities, key = lambda pair: pair[1]):
+            if total <= budget:
+                break
+            evicted.append(filename)
+            total -= size_of[filename]
+            inflation = max(inflation, h)
+        self._delete_filenames(evicted)
+        self._write_sidecar(self._inflation_filename(), repr(inflation))
+        return len(evicted)
 
     def filename(self, index):
         '''
@@ -174,6 +599,9 @@ There's probably a problem with the serializer.''')
         if filename[:i] != self.base_directory:
             raise ValueError('Filename needs to start with "%s";\nyou passed "%s".' % (self.base_directory, filename))
 
+        if self._is_sidecar(filename):
+            return None
+
         if filename.endswith(self.extension):
             if len(self.extension) > 0:
                 j = -len(self.extension)
@@ -187,16 +615,85 @@ There's probably a problem with the serializer.''')
     def _b(self):
         return 'b' if self.binary_mode else ''
 
+    def _dump(self, obj, buf):
+        'Serialize straight into a binary buffer.'
+        if self.binary_mode:
+            self.serializer.dump(obj, buf)
+        else:
+            text = io.TextIOWrapper(buf, encoding = 'utf-8')
+            self.serializer.dump(obj, text)
+            text.flush()
+            text.detach()
+
+    def _load(self, buf):
+        if self.binary_mode:
+            return self.serializer.load(buf)
+        else:
+            text = io.TextIOWrapper(buf, encoding = 'utf-8')
+            try:
+                return self.serializer.load(text)
+            finally:
+                text.detach()
+
     def __delitem__(self, index):
+        self._check_delitem()
+
+    def _check_delitem(self):
         if not self.mutable:
             raise PermissionError('This vlermv is immutable, so you can\'t delete things.')
 
+    def delete_many(self, indices):
+        '''
+        Delete many keys at once; keys that don't exist are skipped.
+        Backends override this with something faster than deleting
+        the keys one at a time.
+        '''
+        self._check_delitem()
+        for index in indices:
+            try:
+                del(self[index])
+            except KeyError:
+                pass
+
+    def clear(self):
+        'Delete everything.'
+        self.delete_many(list(self.keys()))
+
     def __contains__(self, index):
+        if self._definitely_absent(index):
+            return False
         fn = self.filename(index)
         return os.path.isfile(fn)
 
-    def values(self):
-        for key, value in self.items():
+    def _bloom_name(self, index):
+        return self.filename(index)[len(self.base_directory):]
+
+    def _definitely_absent(self, index):
+        'Does the Bloom filter say that the key was never set?'
+        return self.bloom_filter != None and \
+            self._bloom_name(index) not in self.bloom_filter
+
+    def rebuild_bloom_filter(self):
+        '''
+        Rebuild the Bloom filter from the files in the vlermv. Do this if
+        something that doesn't use the same Bloom filter file (another
+        machine, for example) has set values; otherwise, lookups of those
+        values would wrongly say that they are absent.
+        Don't set values while this runs.
+        '''
+        self.bloom_filter.clear()
+        for filename in self._filenames():
+            self.bloom_filter.add(filename[len(self.base_directory):])
+
+    def _filenames(self):
+        'Iterate over the filenames of the values, including base_directory.'
+        raise NotImplementedError
+
+    def values(self, **kwargs):
+        '''
+        Iterate over the values; see :py:meth:`items` for the options.
+        '''
+        for key, value in self.items(**kwargs):
             yield value
 
     def update(self, d):
@@ -205,20 +702,96 @@ There's probably a problem with the serializer.''')
             self[k] = v
 
     def get(self, index, default = None):
+        try:
+            return self._lookup(index)
+        except KeyError:
+            return default
+
+    def _lookup(self, index):
+        '''
+        Get the value for a key, raising :py:class:`KeyError` if there is none.
+        Backends that can do this in a single request (rather than a check
+        with :py:meth:`__contains__` followed by a read) override this,
+        checking :py:meth:`_definitely_absent` first.
+        '''
         if index in self:
             return self[index]
         else:
-            return default
+            raise KeyError(index)
 
-    def items(self):
-        for key in self.keys():
-            yield key, self[key]
+    def items(self, prefetch = 0, workers = None, ordered = True):
+        '''
+        Iterate over ``(key, value)`` pairs.
+
+        :param int prefetch: Number of values to load ahead in background
+            threads; by default, values are loaded one at a time.
+            At most this many values are held in memory beyond the ones
+            that have been yielded.
+        :param int workers: Number of threads for loading values;
+            defaults to ``prefetch``
+        :param bool ordered: If False, yield pairs as soon as their values
+            have loaded rather than in the order of :py:meth:`keys`.
+        '''
+        if prefetch > 0:
+            yield from read_ahead(self.__getitem__, self.keys(), prefetch,
+                                  workers = workers, ordered = ordered)
+        else:
+            for key in self.keys():
+                yield key, self[key]
 
     def __setitem__(self, index, obj):
+        self._before_setitem(index)
+
+    def _before_setitem(self, index):
+        'Check that a key may be set, and add it to the Bloom filter.'
         if (not self.mutable) and (index in self):
             raise PermissionError('This vlermv is not mutable, so you can\'t edit things.')
         if (not self.appendable) and (index not in self):
             raise PermissionError('This vlermv is not appendable, so you can\'t append new things.')
+        # Before writing, so that a failed write leaves a false positive
+        # rather than a false negative
+        if self.bloom_filter != None:
+            self.bloom_filter.add(self._bloom_name(index))
+
+    def open_read(self, index):
+        '''
+        Open the serialized value for a key as a readable binary stream.
+        '''
+        raise NotImplementedError
+
+    def get_range(self, index, offset, length = None):
+        '''
+        Read part of the serialized value for a key without reading
+        all of it.
+
+        :param int offset: Byte offset at which to start
+        :param int length: Number of bytes to read; by default,
+            read to the end.
+        :returns: At most ``length`` bytes, fewer if the value ends sooner
+        :rtype: bytes
+        '''
+        with self.open_read(index) as fp:
+            fp.seek(offset)
+            return fp.read(-1 if length == None else length)
+
+    def lazy(self, index):
+        '''
+        Load a value lazily, with :py:meth:`get_range` fetching only the
+        parts that you use. The serializer must have a ``load_lazy``
+        function that takes a function like ``get_range(offset, length)``.
+
+        :raises TypeError: If the serializer can't load things lazily
+        '''
+        if not hasattr(self.serializer, 'load_lazy'):
+            raise TypeError('Serializer %s cannot load things lazily.' % repr(self.serializer))
+        return self.serializer.load_lazy(lambda offset, length = None: self.get_range(index, offset, length))
+
+    def put_stream(self, index, fileobj):
+        '''
+        Save the contents of a readable binary stream as the serialized
+        value for a key, without loading it all into memory.
+        '''
+        raise NotImplementedError
 
     def __getitem__(self, index):
         raise NotImplementedError
@@ -0,0 +1,254 @@
+import asyncio, io, hashlib
+
+from ._abstract import AbstractVlermv
+from ._exceptions import PermissionError
+from ._s3_layout import S3Layout
+
+def _error_code(error):
+    'Get the S3 error code from a botocore ClientError, or None'
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        return response.get('Error', {}).get('Code')
+
+def _not_found(error):
+    return _error_code(error) in {'404', 'NoSuchKey', 'NotFound'}
+
+class AsyncS3Vlermv(S3Layout, AbstractVlermv):
+    '''
+    An :py:mod:`asyncio` API to an S3 bucket, with the same layout of keys
+    and values as :py:class:`~vlermv.S3Vlermv`. Pass an aiobotocore client
+    (or anything else with the same coroutine methods). ::
+
+        session = aiobotocore.session.get_session()
+        async with session.create_client('s3') as client:
+            v = AsyncS3Vlermv('bucket', 'prefix', client = client)
+            await v.set('a', 1)
+            a = await v.get('a')
+            async for key in v:
+                ...
+
+    Requests don't block the event loop or use threads, so you can have
+    thousands of them in flight at once, for example with
+    :py:func:`asyncio.gather` or the ``*_many`` methods.
+    The bucket must already exist.
+
+    Unlike the other vlermvs, this has no synchronous :py:class:`dict` API,
+    and memoizing it (:py:meth:`memoize`) works only on coroutine functions
+    and without ``ttl``, ``error_ttl``, ``stale_while_revalidate``,
+    ``cache_exceptions``, ``record_cost``, or :py:meth:`memoize_batch`.
+    '''
+
+    #: Maximum number of requests at once in each call to
+    #: :py:meth:`get_many`, :py:meth:`set_many`, and :py:meth:`delete_many`
+    concurrency = 100
+
+    #: Number of keys per multi-object delete request (S3 allows 1000)
+    delete_batch_size = 1000
+
+    def __init__(self, bucketname, *path, client, **kwargs):
+        for key in ['concurrency', 'delete_batch_size']:
+            setattr(self, key, kwargs.pop(key, getattr(self.__class__, key)))
+        super(AsyncS3Vlermv, self).__init__(**kwargs)
+        if self.cache_exceptions:
+            raise TypeError('AsyncS3Vlermv cannot cache exceptions.')
+        if self.bloom_filter != None:
+            raise TypeError('AsyncS3Vlermv cannot use a Bloom filter.')
+        if self.record_cost:
+            raise TypeError('AsyncS3Vlermv cannot record costs.')
+        if self.ttl != None or self.error_ttl != None or self.stale_while_revalidate:
+            raise TypeError('AsyncS3Vlermv cannot expire values.')
+        self.bucketname = bucketname
+        self.client = client
+        self.base_directory = '/'.join(path)
+        if self.base_directory != '':
+            self.base_directory += '/'
+
+    def __repr__(self):
+        return 'AsyncS3Vlermv(%s/%s)' % (self.bucketname, self.base_directory)
+
+    def _sync(self, *args, **kwargs):
+        raise TypeError('AsyncS3Vlermv has no synchronous dict API; await its coroutine methods instead.')
+
+    __getitem__ = __setitem__ = __delitem__ = __contains__ = __len__ = __iter__ = _sync
+    items = values = update = open_read = put_stream = get_range = lazy = _sync
+
+    @classmethod
+    def memoize_batch(Class, *args, **kwargs):
+        raise TypeError('AsyncS3Vlermv cannot memoize batch functions.')
+
+    async def __call__(self, *args, **kwargs):
+        if self.func == None:
+            msg = 'Set %s.func to something if you want to call %s.'
+            raise NotImplementedError(msg % (self, self))
+        index = self._memo_key(args, kwargs)
+        try:
+            return await self.getitem(index)
+        except KeyError:
+            pass
+        result = await self.func(*args, **kwargs)
+        await self.set(index, result)
+        return result
+
+    async def getitem(self, index):
+        '''
+        Get the value for a key.
+
+        :raises KeyError: If there is no such key
+        '''
+        keyname = self.filename(index)
+        try:
+            response = await self.client.get_object(Bucket = self.bucketname, Key = keyname)
+        except Exception as e:
+            if _not_found(e):
+                raise KeyError(keyname)
+            raise
+        body = response['Body']
+        try:
+            data = await body.read()
+        finally:
+            body.close()
+        return self._load(io.BytesIO(data))
+
+    async def get(self, index, default = None):
+        'Get the value for a key, or default if there is no such key.'
+        try:
+            return await self.getitem(index)
+        except KeyError:
+            return default
+
+    async def contains(self, index):
+        try:
+            await self.client.head_object(Bucket = self.bucketname, Key = self.filename(index))
+        except Exception as e:
+            if _not_found(e):
+                return False
+            raise
+        return True
+
+    async def set(self, index, obj):
+        if not (self.mutable and self.appendable):
+            exists = await self.contains(index)
+            if (not self.mutable) and exists:
+                raise PermissionError('This vlermv is not mutable, so you can\'t edit things.')
+            if (not self.appendable) and (not exists):
+                raise PermissionError('This vlermv is not appendable, so you can\'t append new things.')
+
+        buf = io.BytesIO()
+        self._dump(obj, buf)
+        keyname = self.filename(index)
+        if self.skip_unchanged and await self._etag(keyname) == hashlib.md5(buf.getvalue()).hexdigest():
+            return
+        await self.client.put_object(Bucket = self.bucketname, Key = keyname, Body = buf.getvalue())
+        sidecar = self._sidecar(index)
+        if sidecar:
+            suffix, description = sidecar
+            await self.client.put_object(Bucket = self.bucketname, Key = keyname + suffix,
+                                         Body = description.encode('utf-8'))
+
+    async def _etag(self, keyname):
+        ':returns: The ETag of a key, without quotes, or None if there is no such key'
+        try:
+            response = await self.client.head_object(Bucket = self.bucketname, Key = keyname)
+        except Exception as e:
+            if _not_found(e):
+                return None
+            raise
+        return response['ETag'].strip('"')
+
+    async def delete(self, index):
+        '''
+        Delete a key; like :py:meth:`~vlermv.S3Vlermv.__delitem__`,
+        this does not check whether the key exists.
+        '''
+        self._check_delitem()
+        keyname = self.filename(index)
+        await self.client.delete_object(Bucket = self.bucketname, Key = keyname)
+        sidecar = self._sidecar(index)
+        if sidecar:
+            await self.client.delete_object(Bucket = self.bucketname, Key = keyname + sidecar[0])
+
+    async def _gather(self, func, args):
+        'Run func on each of args, at most concurrency at a time.'
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async def bounded(arg):
+            async with semaphore:
+                return await func(arg)
+        return await asyncio.gather(*(bounded(arg) for arg in args))
+
+    async def get_many(self, indices, default = None):
+        '''
+        Get many values at once.
+
+        :returns: A list of the values, with default for keys that don't exist
+        '''
+        return await self._gather(lambda index: self.get(index, default), indices)
+
+    async def set_many(self, items):
+        'Set many values from a dict or from (key, value) pairs.'
+        items = items.items() if hasattr(items, 'items') else items
+        await self._gather(lambda item: self.set(*item), items)
+
+    async def delete_many(self, indices):
+        '''
+        Delete many keys at once, with one multi-object delete request
+        per thousand keys; keys that don't exist are skipped.
+
+        :raises EnvironmentError: If S3 fails to delete some keys
+            (The rest are still deleted.)
+        '''
+        self._check_delitem()
+        keynames = []
+        for index in indices:
+            keyname = self.filename(index)
+            keynames.append(keyname)
+            sidecar = self._sidecar(index)
+            if sidecar:
+                keynames.append(keyname + sidecar[0])
+        await self._delete_keys(keynames)
+
+    async def clear(self):
+        'Delete everything under the prefix.'
+        self._check_delitem()
+        await self._delete_keys([keyname async for keyname in self._list(include_special = True)])
+
+    async def _delete_keys(self, keynames):
+        async def delete_batch(i):
+            batch = keynames[i:i + self.delete_batch_size]
+            response = await self.client.delete_objects(Bucket = self.bucketname, Delete = {
+                'Objects': [{'Key': keyname} for keyname in batch],
+                'Quiet': True,
+            })
+            return response.get('Errors', [])
+        results = await self._gather(delete_batch, range(0, len(keynames), self.delete_batch_size))
+        errors = [error for result in results for error in result]
+        if errors:
+            msg = 'Could not delete %d keys, including %s (%s)'
+            raise EnvironmentError(msg % (len(errors), errors[0].get('Key'), errors[0].get('Message')))
+
+    async def _list(self, include_special = False):
+        '''
+        List the objects under the prefix, skipping S3Vlermv's manifest,
+        cost records and inflation unless include_special is True
+        '''
+        paginator = self.client.get_paginator('list_objects_v2')
+        async for page in paginator.paginate(Bucket = self.bucketname, Prefix = self.base_directory):
+            for obj in page.get('Contents', []):
+                if include_special or not self._is_special(obj['Key']):
+                    yield obj['Key']
+
+    async def keys(self):
+        'Iterate over the keys with ``async for``, listing a page at a time.'
+        async for keyname in self._list():
+            index = self.from_filename(keyname)
+            if index != None:
+                yield index
+
+    def __aiter__(self):
+        return self.keys()
+
+    async def count(self):
+        'Count the keys.'
+        n = 0
+        async for _ in self.keys():
+            n += 1
+        return n
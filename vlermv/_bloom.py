@@ -0,0 +1,96 @@
+import hashlib, math, mmap, os, struct, threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+_MAGIC = b'VLBF'
+_HEADER = struct.Struct('<4sQI')
+
+class BloomFilter:
+    '''
+    A Bloom filter in a memory-mapped file, for answering
+    "definitely absent" without asking the vlermv.
+    Several processes may share the file.
+
+    :param str filename: File for the filter, created if it doesn't exist;
+        if it exists, its size and number of hashes are used rather than
+        those from capacity and error_rate.
+    :param int capacity: Number of keys that the filter is sized for
+    :param float error_rate: Rate of false positives at capacity
+    '''
+    def __init__(self, filename, capacity = 10**6, error_rate = 0.01):
+        self.filename = filename
+        if not os.path.exists(filename):
+            bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+            bits = 8 * math.ceil(bits / 8)
+            hashes = max(1, round(bits / capacity * math.log(2)))
+            self._create(bits, hashes)
+
+        self._fp = open(filename, 'r+b')
+        self._mmap = mmap.mmap(self._fp.fileno(), 0)
+        magic, self.bits, self.hashes = _HEADER.unpack_from(self._mmap)
+        if magic != _MAGIC:
+            raise ValueError('%s is not a Bloom filter.' % filename)
+        self._lock = threading.Lock()
+
+    def _create(self, bits, hashes):
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp, 'wb') as fp:
+            fp.write(_HEADER.pack(_MAGIC, bits, hashes))
+            fp.truncate(_HEADER.size + bits // 8)
+        os.rename(tmp, self.filename)
+
+    def __repr__(self):
+        return 'BloomFilter(%s)' % repr(self.filename)
+
+    def _positions(self, item):
+        if isinstance(item, str):
+            item = item.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.blake2b(item, digest_size = 16).digest())
+        h2 |= 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def add(self, item):
+        positions = list(self._positions(item))
+        with self._lock:
+            # Setting a bit is a read and a write, so lock out other processes.
+            if fcntl:
+                fcntl.lockf(self._fp, fcntl.LOCK_EX)
+            try:
+                for position in positions:
+                    i = _HEADER.size + position // 8
+                    self._mmap[i] = self._mmap[i] | (1 << (position % 8))
+            finally:
+                if fcntl:
+                    fcntl.lockf(self._fp, fcntl.LOCK_UN)
+
+    def __contains__(self, item):
+        '''
+        False means that the item was definitely never added;
+        True means that it probably was.
+        '''
+        for position in self._positions(item):
+            if not self._mmap[_HEADER.size + position // 8] & (1 << (position % 8)):
+                return False
+        return True
+
+    def clear(self):
+        with self._lock:
+            if fcntl:
+                fcntl.lockf(self._fp, fcntl.LOCK_EX)
+            try:
+                self._mmap[_HEADER.size:] = bytes(self.bits // 8)
+            finally:
+                if fcntl:
+                    fcntl.lockf(self._fp, fcntl.LOCK_UN)
+
+    def close(self):
+        self._mmap.close()
+        self._fp.close()
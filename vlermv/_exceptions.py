@@ -5,6 +5,16 @@ except NameError:
 else:
     OpenError = FileNotFoundError
 
+try:
+    FileNotFoundError
+except NameError:
+    MissingError = IOError
+else:
+    #: Errors from opening the file for a key that isn't set; the path may
+    #: be a directory, or under a file, if the key is a prefix of another
+    #: key or has one as its prefix.
+    MissingError = (FileNotFoundError, IsADirectoryError, NotADirectoryError)
+
 try:
     PermissionError
 except NameError:
@@ -1,14 +1,19 @@
-import os
+import os, shutil, threading, itertools, hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from random import randint
 from string import ascii_letters
 
 from ._exceptions import DeleteError, PermissionError, out_of_space
 from ._abstract import AbstractVlermv
-from ._exceptions import OpenError
+from ._exceptions import OpenError, MissingError
+from ._util import read_ahead
 
-def _get_fn(fn, mode, load):
+def _get_fn(fn, mode, load, dated = False):
     '''
     Load a contents, checking that the file was not modified during the read.
+
+    :param bool dated: Return the modification time too
     '''
     try:
         mtime_before = os.path.getmtime(fn)
@@ -23,11 +28,25 @@ def _get_fn(fn, mode, load):
     else:
         mtime_after = os.path.getmtime(fn)
         if mtime_before in {None, mtime_after}:
-            return item
+            return (item, mtime_after) if dated else item
         else:
             raise EnvironmentError('File was edited during read: %s' % fn)
 
 
+#: Extended attribute with the SHA-256 of a file, for skip_unchanged
+DIGEST_XATTR = 'user.vlermv.sha256'
+
+def _stamp(st):
+    'What changes when a file is edited, from os.stat'
+    return '%d %d %d' % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _file_digest(fn):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
 def _random_file_name():
     n = len(ascii_letters) - 1
     return ''.join(ascii_letters[randint(0, n)] for _ in range(10))
@@ -42,10 +61,107 @@ def mktemp(tempdir, filename = _random_file_name):
     return os.path.join(tempdir, filename())
 
 def _reversed_directories(outer, inner):
-    while outer != inner:
+    'Yield inner and its parents, up to but not including outer.'
+    # Normalised, so that a trailing slash on outer doesn't walk past it
+    outer = os.path.normpath(outer)
+    while os.path.normpath(inner) != outer and os.path.dirname(inner) != inner:
         yield inner
         inner = os.path.dirname(inner)
 
+def _scan_directory(path, skip, inodes = False):
+    '''
+    List a directory with one scandir call.
+
+    :param bool inodes: Return ``(path, inode)`` pairs for the files rather
+        than just the paths; the inodes come from the listing, without stat.
+    :param skip: Paths of subdirectories to leave out
+    :returns: The paths of the files and of the subdirectories, except skip
+        (Symbolic links to directories are neither, like in os.walk.)
+    '''
+    files, directories = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    files.append((entry.path, entry.inode()) if inodes else entry.path)
+                elif entry.path not in skip and not entry.is_symlink():
+                    directories.append(entry.path)
+    except OSError:
+        pass # like os.walk
+    return files, directories
+
+def _walk(directory, skip, workers = None, ordered = True, inodes = False):
+    '''
+    Yield the paths of the files under a directory, not descending into
+    the directories in skip.
+    (See :py:func:`_scan_directory` for inodes.)
+
+    :param int workers: Number of threads for listing directories at once;
+        by default, directories are listed one at a time.
+    :param bool ordered: Yield files in the order that a serial traversal
+        would (True) or as soon as their directories have been listed (False)
+    '''
+    if not workers or workers <= 1:
+        stack = [directory]
+        while stack:
+            files, directories = _scan_directory(stack.pop(), skip, inodes)
+            yield from files
+            stack.extend(reversed(directories))
+        return
+
+    executor = ThreadPoolExecutor(max_workers = workers)
+    scan = lambda path: executor.submit(_scan_directory, path, skip, inodes)
+    try:
+        if ordered:
+            # Subdirectories are listed once their parent is reached, so the
+            # pending listings are only those beside the current path.
+            def walk(future):
+                files, directories = future.result()
+                futures = [scan(path) for path in directories]
+                yield from files
+                for future in futures:
+                    yield from walk(future)
+            yield from walk(scan(directory))
+        else:
+            pending = {scan(directory)}
+            while pending:
+                done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    files, directories = future.result()
+                    pending.update(scan(path) for path in directories)
+                    yield from files
+    finally:
+        executor.shutdown(wait = True, cancel_futures = True)
+
+def _will_need(filename):
+    'Ask the kernel to start reading a file into the page cache.'
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+def _hinted(pairs, window):
+    '''
+    Yield the keys from ``(key, filename)`` pairs, hinting that each file
+    will be needed when it is window files ahead of the one being yielded.
+    '''
+    pairs = iter(pairs)
+    ahead = deque()
+    def hint(n):
+        for key, filename in itertools.islice(pairs, n):
+            _will_need(filename)
+            ahead.append(key)
+    hint(window)
+    while ahead:
+        key = ahead.popleft()
+        hint(1)
+        yield key
+
 class Vlermv(AbstractVlermv):
     '''
     A :py:class:`dict` API to a filesystem
@@ -55,6 +171,19 @@ class Vlermv(AbstractVlermv):
     #: This is is mostly relevant for testing.
     _mkdir = True
 
+    #: Number of threads for listing directories in :py:meth:`keys`
+    #: and :py:meth:`__len__`; this helps mostly on network filesystems.
+    #: By default, directories are listed one at a time.
+    scan_workers = None
+
+    #: Number of files ahead of the current one to hint to the kernel
+    #: when reading in disk order (see :py:meth:`items`)
+    hint_window = 32
+
+    #: Directory, relative to base_directory, for the digests of
+    #: ``skip_unchanged`` on filesystems without extended attributes
+    digest_directory = '.vlermv-digests'
+
     def __init__(self, *directory, tempdir = '.tmp', **kwargs):
         '''
         :param str directory: Top-level directory of the vlermv
@@ -69,6 +198,7 @@ class Vlermv(AbstractVlermv):
         :type key_transformer: :py:mod:`key_transformer <vlermvtransformers>`
         :param bool mutable: Whether values can be updated and deleted
         :param str tempdir: Subdirectory inside of base_directory to use for temporary files
+        :param int scan_workers: Number of threads for listing directories
 
         These are mostly relevant for initialization via :py:func:`vlermv.cache`.
 
@@ -79,9 +209,13 @@ class Vlermv(AbstractVlermv):
         :param bool cache_exceptions: If the decorated function raises
             an exception, should the failure and exception be cached?
             The exception is raised either way.
+        :param bool key_kwargs: Should keyword arguments to the decorated
+            function be part of the key?
         :raises TypeError: If cache_exceptions is True but the serializer
             can't cache exceptions
         '''
+        for key in ['scan_workers', 'hint_window']:
+            setattr(self, key, kwargs.pop(key, getattr(self.__class__, key)))
         super(Vlermv, self).__init__(**kwargs)
         self.base_directory = os.path.expanduser(os.path.join(*directory))
         self.tempdir = os.path.join(self.base_directory, tempdir)
@@ -93,6 +227,57 @@ class Vlermv(AbstractVlermv):
 
     def __setitem__(self, index, obj):
         super(Vlermv, self).__setitem__(index, obj)
+        self._write(index, 'w+' + self._b(), lambda fp: self.serializer.dump(obj, fp))
+
+    def put_stream(self, index, fileobj):
+        '''
+        Save the contents of a binary file-like object as the serialized
+        value for a key, copying it in chunks rather than loading it into
+        memory. Like :py:meth:`__setitem__`, the file is written to the
+        temporary directory and then renamed into place.
+        '''
+        self._before_setitem(index)
+        self._write(index, 'wb', lambda fp: shutil.copyfileobj(fileobj, fp))
+
+    def open_read(self, index):
+        '''
+        Open the serialized value for a key as a binary file,
+        for reading large values without loading them into memory.
+        '''
+        try:
+            return open(self.filename(index), 'rb')
+        except MissingError:
+            raise KeyError(index)
+
+    def get_range(self, index, offset, length = None):
+        '''
+        Read part of the serialized value for a key with :py:func:`os.pread`,
+        without reading the rest of the file.
+        '''
+        try:
+            fd = os.open(self.filename(index), os.O_RDONLY)
+        except MissingError:
+            raise KeyError(index)
+        try:
+            if length == None:
+                length = max(0, os.fstat(fd).st_size - offset)
+            chunks = []
+            while length > 0:
+                if hasattr(os, 'pread'):
+                    chunk = os.pread(fd, length, offset)
+                else:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    chunk = os.read(fd, length)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+                length -= len(chunk)
+            return b''.join(chunks)
+        finally:
+            os.close(fd)
+
+    def _write(self, index, mode, write):
         fn = self.filename(index)
         os.makedirs(os.path.dirname(fn), exist_ok = True)
         exists = os.path.exists(fn)
@@ -102,9 +287,9 @@ class Vlermv(AbstractVlermv):
             raise PermissionError('This warehouse not appendable, and %s does not exist.' % fn)
         else:
             tmp = mktemp(self.tempdir)
-            with open(tmp, 'w+' + self._b()) as fp:
+            with open(tmp, mode) as fp:
                 try:
-                    self.serializer.dump(obj, fp)
+                    write(fp)
                 except Exception as e:
                     if out_of_space(e):
                         fp.close()
@@ -112,12 +297,91 @@ class Vlermv(AbstractVlermv):
                         raise BufferError('Out of space')
                     else:
                         raise
+            if self.skip_unchanged:
+                digest = _file_digest(tmp)
+                if exists and os.path.getsize(fn) == os.path.getsize(tmp) and \
+                        self._stored_digest(fn) == digest:
+                    os.remove(tmp)
+                    if self.ttl != None or self.error_ttl != None:
+                        # The value counts as saved now, so it doesn't expire.
+                        os.utime(fn)
+                        self._store_digest(fn, digest)
+                    return
             os.rename(tmp, fn)
+            if self.skip_unchanged:
+                self._store_digest(fn, digest)
+
+            sidecar = self._sidecar(index)
+            if sidecar:
+                suffix, description = sidecar
+                self._write_sidecar(fn + suffix, description)
+
+    def _write_sidecar(self, filename, text):
+        os.makedirs(os.path.dirname(filename), exist_ok = True)
+        tmp = mktemp(self.tempdir)
+        with open(tmp, 'w') as fp:
+            fp.write(text)
+        os.rename(tmp, filename)
+
+    def _stored_digest(self, fn):
+        '''
+        Get the digest of a file from its extended attribute (or from
+        digest_directory), or by reading the file if that is missing or
+        the file has been changed since.
+        '''
+        try:
+            record = os.getxattr(fn, DIGEST_XATTR).decode('ascii')
+        except (AttributeError, OSError):
+            # Not Linux, a filesystem without extended attributes,
+            # or a file that was saved without skip_unchanged
+            record = self._read_sidecar(self._record_filename(self.digest_directory, fn))
+        if record != None:
+            digest, _, stamp = record.partition(' ')
+            if stamp == _stamp(os.stat(fn)):
+                return digest
+        digest = _file_digest(fn)
+        self._store_digest(fn, digest)
+        return digest
+
+    def _store_digest(self, fn, digest):
+        'Record the digest of a file with the size, inode, and time that it has now.'
+        record = '%s %s' % (digest, _stamp(os.stat(fn)))
+        try:
+            # Setting this changes the ctime but not the mtime.
+            os.setxattr(fn, DIGEST_XATTR, record.encode('ascii'))
+        except (AttributeError, OSError):
+            self._write_sidecar(self._record_filename(self.digest_directory, fn), record)
+
+    def _read_sidecar(self, filename):
+        try:
+            with open(filename) as fp:
+                return fp.read()
+        except OpenError:
+            return None
 
     def __getitem__(self, index):
         try:
             return _get_fn(self.filename(index), 'r+' + self._b(), self.serializer.load)
-        except OpenError:
+        except MissingError:
+            raise KeyError(index)
+
+    def _lookup(self, index):
+        if self._definitely_absent(index):
+            raise KeyError(index)
+        return self[index]
+
+    def _lookup_dated(self, index):
+        if self._definitely_absent(index):
+            raise KeyError(index)
+        try:
+            return _get_fn(self.filename(index), 'r+' + self._b(), self.serializer.load, dated = True)
+        except MissingError:
+            raise KeyError(index)
+
+    def _mtime(self, index):
+        try:
+            return os.path.getmtime(self.filename(index))
+        except MissingError:
             raise KeyError(index)
 
     def __delitem__(self, index):
@@ -128,23 +392,172 @@ class Vlermv(AbstractVlermv):
         except DeleteError as e:
             raise KeyError(*e.args)
         else:
+            self._remove_sidecars(fn)
             for fn in _reversed_directories(self.base_directory, os.path.dirname(fn)):
                 if os.listdir(fn) == []:
                     os.rmdir(fn)
                 else:
                     break
 
+    def delete_many(self, indices):
+        '''
+        Delete many keys at once; keys that don't exist are skipped.
+        Empty directories are removed once at the end rather than after
+        each file.
+        '''
+        self._check_delitem()
+        self._delete_filenames(self.filename(index) for index in indices)
+
+    def _remove_sidecars(self, fn):
+        for suffix in self._sidecar_suffixes():
+            try:
+                os.remove(fn + suffix)
+            except DeleteError:
+                pass
+        # Whether or not this vlermv records costs, the one that saved fn may have.
+        self._remove_record(self.cost_directory, fn)
+        if self.skip_unchanged:
+            self._remove_record(self.digest_directory, fn)
+
+    def _remove_record(self, directory, fn):
+        'Remove the file for fn under directory, and any directories that empties.'
+        record_fn = self._record_filename(directory, fn)
+        try:
+            os.remove(record_fn)
+        except DeleteError:
+            return
+        root = os.path.join(self.base_directory, directory)
+        for parent in _reversed_directories(root, os.path.dirname(record_fn)):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break # not empty
+
+    def _delete_filenames(self, filenames):
+        directories = set()
+        for fn in filenames:
+            try:
+                os.remove(fn)
+            except DeleteError:
+                continue
+            self._remove_sidecars(fn)
+            directories.update(_reversed_directories(self.base_directory, os.path.dirname(fn)))
+
+        # Deepest first, so that parents are empty by the time we get to them
+        for fn in sorted(directories, key = lambda fn: fn.count(os.sep), reverse = True):
+            try:
+                os.rmdir(fn)
+            except OSError:
+                pass # not empty
+
+    def clear(self):
+        '''
+        Delete everything. The directory is renamed aside, so it looks empty
+        immediately, and then removed in a background thread. If the
+        directory can't be renamed (because it is a mount point, or because
+        its parent isn't writable), its contents are moved into a directory
+        inside tempdir instead.
+
+        :returns: The thread that removes the old directory, in case you
+            want to wait for it, or None if the directory did not exist
+        :rtype: threading.Thread
+        '''
+        self._check_delitem()
+        base_directory = os.path.abspath(self.base_directory)
+        try:
+            aside = mktemp(os.path.dirname(base_directory),
+                lambda: '.%s.deleting-%s' % (os.path.basename(base_directory), _random_file_name()))
+            os.rename(base_directory, aside)
+        except OpenError:
+            aside = None
+        except OSError:
+            aside = self._clear_contents(base_directory)
+        if aside == None:
+            thread = None
+        else:
+            thread = threading.Thread(target = shutil.rmtree, args = (aside,),
+                                      kwargs = {'ignore_errors': True})
+            thread.start()
+        if self._mkdir:
+            os.makedirs(self.tempdir, exist_ok = True)
+        if self.bloom_filter != None:
+            self.bloom_filter.clear()
+        return thread
+
+    def _clear_contents(self, base_directory):
+        '''
+        Move everything in the directory but tempdir into a new directory
+        inside tempdir, which keys() doesn't look in.
+
+        :returns: The new directory
+        '''
+        tempdir = os.path.abspath(self.tempdir)
+        aside = mktemp(tempdir, lambda: 'deleting-%s' % _random_file_name())
+        os.mkdir(aside)
+        for name in os.listdir(base_directory):
+            path = os.path.join(base_directory, name)
+            if path != tempdir and not tempdir.startswith(path + os.sep):
+                os.rename(path, os.path.join(aside, name))
+        return aside
+
     def __len__(self):
-        length = 0
-        for dirpath, _, filenames in os.walk(self.base_directory):
-            for filename in filenames:
-                length += 1
-        return length
-
-    def keys(self):
-        for dirpath, _, filenames in os.walk(self.base_directory):
-            if dirpath != os.path.join(self.base_directory, self.tempdir):
-                for filename in filenames:
-                    path = self.from_filename(os.path.abspath(os.path.join(dirpath, filename)))
-                    if path != None:
-                        yield path
+        return sum(1 for _ in self.keys(ordered = False))
+
+    def _filenames(self, workers = None, ordered = True, inodes = False):
+        skip = {self.tempdir, os.path.join(self.base_directory, self.cost_directory),
+                os.path.join(self.base_directory, self.digest_directory)}
+        return _walk(self.base_directory, skip,
+                     workers = self.scan_workers if workers == None else workers,
+                     ordered = ordered, inodes = inodes)
+
+    def _sizes(self):
+        for filename in self._filenames(ordered = False):
+            if self.from_filename(filename) != None:
+                try:
+                    yield filename, os.path.getsize(filename)
+                except OpenError:
+                    pass # deleted since it was listed
+
+    def _inflation_filename(self):
+        return os.path.join(self.tempdir, 'inflation')
+
+    def items(self, prefetch = 0, workers = None, ordered = True, disk_order = False):
+        '''
+        Iterate over ``(key, value)`` pairs; see
+        :py:meth:`AbstractVlermv.items <vlermv._abstract.AbstractVlermv.items>`
+        for the other options.
+
+        :param bool disk_order: Read the values in inode order, which is
+            usually close to their order on disk, rather than in directory
+            order, and tell the kernel which files will be read next
+            (with posix_fadvise). This makes full scans of spinning disks
+            much faster. All the keys are listed before the first value is read.
+        '''
+        if not disk_order:
+            yield from super(Vlermv, self).items(prefetch = prefetch, workers = workers, ordered = ordered)
+            return
+
+        files = sorted(self._filenames(ordered = False, inodes = True), key = lambda f: f[1])
+        pairs = ((key, filename) for filename, _ in files
+                 for key in [self.from_filename(filename)] if key != None)
+        keys = _hinted(pairs, max(self.hint_window, prefetch))
+        if prefetch > 0:
+            yield from read_ahead(self.__getitem__, keys, prefetch,
+                                  workers = workers, ordered = ordered)
+        else:
+            for key in keys:
+                yield key, self[key]
+
+    def keys(self, workers = None, ordered = True):
+        '''
+        Iterate over the keys, skipping the temporary directory.
+
+        :param int workers: Number of threads for listing directories;
+            defaults to ``scan_workers``
+        :param bool ordered: If False, yield keys as soon as their directories
+            have been listed rather than in directory traversal order.
+        '''
+        for filename in self._filenames(workers, ordered):
+            path = self.from_filename(filename)
+            if path != None:
+                yield path
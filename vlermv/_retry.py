@@ -0,0 +1,139 @@
+import itertools, os, queue, random, socket, threading, time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+def _remaining(end):
+    if end == None:
+        return None
+    return max(0, end - time.monotonic())
+
+class _Workers:
+    '''
+    Daemon threads for calls with deadlines, so an abandoned call cannot
+    block exit. Threads are reused, so they keep their S3 connections,
+    and exit after idling for idle_timeout seconds.
+    '''
+    def __init__(self, idle_timeout = 60):
+        self.idle_timeout = idle_timeout
+        self._after_fork()
+
+    def _after_fork(self):
+        # A forked child has none of the threads, and a lock held by one
+        # of them at fork time would never be released.
+        self._lock = threading.Lock()
+        self._tasks = queue.SimpleQueue()
+        # Waiting threads minus queued tasks
+        self._idle = 0
+
+    def submit(self, func):
+        future = Future()
+        with self._lock:
+            self._tasks.put((future, func))
+            if self._idle > 0:
+                self._idle -= 1
+            else:
+                threading.Thread(target = self._work, daemon = True).start()
+        return future
+
+    def _work(self):
+        while True:
+            try:
+                future, func = self._tasks.get(timeout = self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    if self._tasks.empty():
+                        self._idle -= 1
+                        return
+                continue
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func())
+                except BaseException as e:
+                    future.set_exception(e)
+            del future, func
+            with self._lock:
+                self._idle += 1
+
+_workers = _Workers()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child = _workers._after_fork)
+
+def _discard_later(futures, discard):
+    'Pass the results of calls that are not used to discard, when they finish.'
+    def callback(future):
+        if future.exception() == None:
+            discard(future.result())
+    for future in futures:
+        future.add_done_callback(callback)
+
+def hedge(func, hedge_after = None, timeout = None, discard = None):
+    '''
+    Call func, and call it again if the first call has not finished after
+    hedge_after seconds; return the result of whichever finishes first.
+
+    :param discard: Function to clean up the results that aren't returned,
+        for example by closing them
+    :raises socket.timeout: If neither call finishes within timeout seconds
+        (The calls are abandoned, not stopped.)
+    '''
+    if hedge_after == None and timeout == None:
+        return func()
+
+    end = None if timeout == None else time.monotonic() + timeout
+    calls = [_workers.submit(func)]
+    pending = set(calls)
+    hedged = hedge_after == None
+    error = None
+    while pending:
+        wait_for = _remaining(end)
+        if not hedged:
+            wait_for = hedge_after if wait_for == None else min(wait_for, hedge_after)
+        done, pending = wait(pending, timeout = wait_for, return_when = FIRST_COMPLETED)
+        for future in done:
+            if future.exception() == None:
+                if discard != None:
+                    _discard_later([f for f in calls if f is not future], discard)
+                return future.result()
+            error = future.exception()
+        if not done:
+            if end != None and time.monotonic() >= end:
+                if discard != None:
+                    _discard_later(calls, discard)
+                raise socket.timeout('Deadline exceeded')
+            elif not hedged:
+                hedged = True
+                calls.append(_workers.submit(func))
+                pending.add(calls[-1])
+    raise error
+
+def retry(func, retries = 0, backoff = 0.1, max_backoff = 10, deadline = None,
+          hedge_after = None, retryable = lambda error: False, sleep = time.sleep,
+          discard = None):
+    '''
+    Call func, retrying after errors for which retryable returns True,
+    with jittered exponential backoff. Only use this for idempotent calls.
+
+    :param int retries: Number of times to retry
+    :param float backoff: Seconds to wait before the first retry, at most;
+        this doubles after each retry. The actual wait is a random
+        fraction of it, so clients that failed together don't retry together.
+    :param float max_backoff: Maximum seconds to wait between attempts
+    :param float deadline: Seconds that all attempts together may take
+    :param float hedge_after: Seconds after which to start a second,
+        simultaneous call in each attempt (see :py:func:`hedge`)
+    :param retryable: Function that says whether an exception is transient
+    :param discard: Function to clean up results of hedged or abandoned
+        calls that aren't returned (see :py:func:`hedge`)
+    :raises socket.timeout: If the deadline passes
+    '''
+    end = None if deadline == None else time.monotonic() + deadline
+    for attempt in itertools.count():
+        try:
+            return hedge(func, hedge_after, _remaining(end), discard)
+        except Exception as e:
+            if attempt >= retries or not retryable(e):
+                raise
+            delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+            if end != None and time.monotonic() + delay >= end:
+                raise
+        sleep(delay)
@@ -1,21 +1,207 @@
-import tempfile, socket
+import os, shutil, tempfile, socket, io, json, zlib, threading, time, hashlib
+from concurrent.futures import ThreadPoolExecutor
+import http.client, email.utils
+
+from boto.exception import S3ResponseError
+from boto.s3.multipart import MultiPartUpload
 
 from ._abstract import AbstractVlermv
+from ._exceptions import OpenError, DeleteError
+from ._fs import mktemp, _random_file_name
+from ._retry import retry
+from ._s3_layout import S3Layout
 from ._safe_buckets import SafeBuckets
+from ._util import read_ahead
+
+class _KeyReader(io.RawIOBase):
+    'Read an S3 key as a raw binary stream.'
+    def __init__(self, key, timeout):
+        self.key = key
+        self.timeout = timeout
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(b) == 0 or self.eof:
+            return 0
+        try:
+            data = self.key.read(len(b))
+        except socket.timeout:
+            raise self.timeout('Timeout when reading from S3')
+        if not data:
+            # boto closes the key at the end, and reading it again would
+            # start another download from the beginning.
+            self.eof = True
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            # Don't download the rest of the key just to close it.
+            self.key.close(fast = True)
+        super(_KeyReader, self).close()
+
+def _not_found(error):
+    return isinstance(error, S3ResponseError) and error.status == 404
+
+def _transient(error):
+    'Is this an error that may go away if the request is repeated?'
+    if isinstance(error, S3ResponseError):
+        return error.status >= 500 or error.error_code == 'RequestTimeout'
+    # Not all OSErrors, which include local errors like running out of space
+    return isinstance(error, (socket.timeout, ConnectionError, http.client.HTTPException))
+
+def _timestamp(last_modified):
+    'Convert a Last-Modified header to seconds since the epoch.'
+    if last_modified:
+        return email.utils.parsedate_to_datetime(last_modified).timestamp()
+
+def _range(start, length):
+    return {'Range': 'bytes=%d-%d' % (start, start + length - 1)}
+
+def _read_full(fp, size):
+    '''
+    Read size bytes, or fewer only at the end of the file; a single read
+    of a pipe or socket may return less even before the end.
+    '''
+    chunks = []
+    while size > 0:
+        chunk = fp.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def _seekable(fp):
+    try:
+        return fp.seekable()
+    except AttributeError:
+        return False
+
+class S3Vlermv(S3Layout, AbstractVlermv):
+    '''
+    A :py:class:`dict` API to an S3 bucket
 
-class S3Vlermv(AbstractVlermv):
+    An S3Vlermv may be used from several threads at once; each thread uses
+    its own connection from :py:attr:`buckets`. (If you pass your own
+    ``bucket``, it is shared by all threads.)
+    '''
+
+    #: Creates buckets and holds one connection per thread;
+    #: replace it to configure connections, for example
+    #: ``S3Vlermv.buckets = SafeBuckets(keep_alive = 300)``.
     buckets = SafeBuckets()
 
+    #: Size of the parts for multipart uploads and ranged downloads
+    #: (S3 requires at least 5 MiB)
+    part_size = 8 * 2**20
+
+    #: Values larger than this many bytes are uploaded in parts
+    #: and downloaded with ranged requests.
+    multipart_threshold = 64 * 2**20
+
+    #: Number of parts to transfer at once
+    transfer_workers = 4
+
+    #: Values are transferred through in-memory buffers that
+    #: spill to temporary files only above this many bytes.
+    spool_size = 8 * 2**20
+
+    #: Keep a manifest of the key names under the prefix, so that
+    #: :py:meth:`keys` and :py:meth:`__len__` read the manifest and its
+    #: recent updates instead of listing the whole prefix?
+    manifest = False
+
+    #: Seconds after an update to the manifest is written before it is
+    #: compacted into the manifest (by mutable S3Vlermvs), and after a
+    #: compaction before the updates are deleted. Writes and compactions that take longer than
+    #: this (or clocks that differ by more) may lose updates.
+    manifest_grace = 60
+
+    #: Directory for caching values on local disk, or None to not cache.
+    #: Values are cached under a subdirectory named after the bucket,
+    #: and they are revalidated with their ETags.
+    local_cache = None
+
+    #: Seconds after downloading or revalidating a cached value during
+    #: which it is used without asking S3 whether it has changed
+    freshness = 0
+
+    #: Number of times to retry requests that fail with timeouts,
+    #: connection errors, or server errors. Only idempotent requests
+    #: are retried: reads, whole-value and part uploads, and deletes.
+    retries = 2
+
+    #: Seconds to wait before the first retry, at most; this doubles after
+    #: each retry, up to max_backoff, and the actual wait is a random
+    #: fraction of it.
+    backoff = 0.1
+
+    #: Maximum seconds to wait between retries
+    max_backoff = 10
+
+    #: If a read has not finished after this many seconds, send a second,
+    #: identical request and use whichever response finishes first;
+    #: None to never hedge.
+    hedge_after = None
+
+    #: Seconds that each request may take, including its retries, before
+    #: raising :py:class:`Timeout`; None for no deadline.
+    deadline = None
+
+    #: Number of keys per multi-object delete request (S3 allows 1000)
+    delete_batch_size = 1000
+
     def __init__(self, bucketname, *path, bucket = None, **kwargs):
+        for key in ['part_size', 'multipart_threshold', 'transfer_workers',
+                    'spool_size', 'manifest', 'manifest_grace', 'local_cache', 'freshness',
+                    'retries', 'backoff', 'max_backoff', 'hedge_after', 'deadline',
+                    'delete_batch_size']:
+            setattr(self, key, kwargs.pop(key, getattr(self.__class__, key)))
         super(S3Vlermv, self).__init__(**kwargs)
-        if bucket:
-            self.bucket = bucket
-        else:
-            self.bucket = self.buckets[bucketname]
+        self.bucketname = bucketname
+        self._bucket = bucket
+        if not bucket:
+            # Create the bucket now rather than on first use.
+            self.buckets[bucketname]
 
         self.base_directory = '/'.join(path)
         if self.base_directory != '':
             self.base_directory += '/'
+        if self.local_cache:
+            self.local_cache = os.path.expanduser(self.local_cache)
+        self._transfers = None
+        self._transfers_lock = threading.Lock()
+
+    def _transfer_executor(self):
+        '''
+        Threads for the parts of transfers, which live as long as this
+        S3Vlermv so that they keep their S3 connections between transfers
+        '''
+        with self._transfers_lock:
+            # Threads aren't inherited by forked processes.
+            if self._transfers == None or self._transfers_pid != os.getpid():
+                self._transfers = ThreadPoolExecutor(max_workers = self.transfer_workers)
+                self._transfers_pid = os.getpid()
+            return self._transfers
+
+    def close(self):
+        'Stop the threads that transfer parts of values.'
+        with self._transfers_lock:
+            if self._transfers != None:
+                self._transfers.shutdown(wait = True)
+                self._transfers = None
+
+    @property
+    def bucket(self):
+        'The bucket, bound to the current thread\'s connection'
+        if self._bucket:
+            return self._bucket
+        else:
+            return self.buckets.local(self.bucketname)
 
     def __repr__(self):
         return 'S3Vlermv(%s/%s)' % (self.bucket.name, self.base_directory)
@@ -23,50 +209,528 @@ class S3Vlermv(AbstractVlermv):
     def __setitem__(self, index, obj):
         super(S3Vlermv, self).__setitem__(index, obj)
         keyname = self.filename(index)
-        key = self.bucket.new_key(keyname)
-        with tempfile.NamedTemporaryFile('w+' + self._b()) as tmp:
-            self.serializer.dump(obj, tmp.file)
-            tmp.file.close()
-            key.set_contents_from_filename(tmp.name, replace = True)
+        with self._spool() as buf:
+            self._dump(obj, buf)
+            buf.seek(0)
+            # Last-Modified can't be refreshed without a write,
+            # and values with a ttl would never stop being expired.
+            if self.skip_unchanged and self.ttl == None and self.error_ttl == None \
+                    and self._unchanged(keyname, buf):
+                return
+            self._upload(keyname, buf)
+        self._after_put(index, keyname)
+
+    def _unchanged(self, keyname, fp):
+        '''
+        Does the key already have the contents of fp? This compares the
+        ETag that S3 would give fp, if this S3Vlermv uploaded it,
+        with the ETag of the key, so values uploaded in different parts
+        (or with server-side encryption with KMS) look changed.
+        '''
+        key = self._retry(lambda: self.bucket.get_key(keyname), hedge = True)
+        return key != None and key.etag.strip('"') == self._etag(fp)
+
+    def _etag(self, fp):
+        size = fp.seek(0, io.SEEK_END)
+        fp.seek(0)
+        try:
+            if size <= self.multipart_threshold or size < self.part_size:
+                return hashlib.md5(fp.read()).hexdigest()
+            digests = [hashlib.md5(chunk).digest() for chunk in iter(lambda: fp.read(self.part_size), b'')]
+            return '%s-%d' % (hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+        finally:
+            fp.seek(0)
+
+    def _retry(self, func, hedge = False, discard = None):
+        '''
+        Call func, which makes an idempotent request, with retries, the
+        deadline, and (for reads, if hedge is True) hedging
+        '''
+        return retry(func, self.retries, self.backoff, self.max_backoff,
+                     self.deadline, self.hedge_after if hedge else None, _transient,
+                     discard = discard)
+
+    def _spool(self):
+        return tempfile.SpooledTemporaryFile(max_size = self.spool_size)
+
+    def put_stream(self, index, fileobj):
+        '''
+        Upload a binary file-like object as the serialized value for a key,
+        without an intermediate temporary file.
+        '''
+        self._before_setitem(index)
+        keyname = self.filename(index)
+        self._upload(keyname, fileobj)
+        self._after_put(index, keyname)
+
+    def _upload(self, keyname, fp):
+        '''
+        Upload from the current position of fp to its end, in one request
+        if it is small and in parts if it is large or of unknown size.
+        '''
+        if _seekable(fp):
+            start = fp.tell()
+            size = fp.seek(0, io.SEEK_END) - start
+            fp.seek(start)
+            if size <= self.multipart_threshold:
+                def put():
+                    fp.seek(start)
+                    self.bucket.new_key(keyname).set_contents_from_file(fp, replace = True)
+                self._retry(put)
+                return
+        self._put_parts(keyname, fp)
+
+    def _put_parts(self, keyname, fp):
+        first = _read_full(fp, self.part_size)
+        if len(first) < self.part_size:
+            self._retry(lambda: self.bucket.new_key(keyname).set_contents_from_string(first, replace = True))
+            return
+
+        def parts():
+            part_num, chunk = 1, first
+            while chunk:
+                yield part_num, chunk
+                part_num, chunk = part_num + 1, _read_full(fp, self.part_size)
+
+        def upload_part(part):
+            part_num, chunk = part
+            # Use this thread's connection.
+            bucket = self.bucket
+            if bucket is upload.bucket:
+                thread_upload = upload
+            else:
+                thread_upload = MultiPartUpload(bucket)
+                thread_upload.key_name, thread_upload.id = upload.key_name, upload.id
+            self._retry(lambda: thread_upload.upload_part_from_file(io.BytesIO(chunk), part_num))
+
+        # At most transfer_workers parts are held in memory at once.
+        upload = self.bucket.initiate_multipart_upload(keyname)
+        try:
+            for _ in read_ahead(upload_part, parts(), self.transfer_workers,
+                                executor = self._transfer_executor()):
+                pass
+        except:
+            upload.cancel_upload()
+            raise
+        else:
+            upload.complete_upload()
+
+    def _after_put(self, index, keyname):
+        self._forget_local(keyname)
+        sidecar = self._sidecar(index)
+        if sidecar:
+            suffix, description = sidecar
+            self._write_sidecar(keyname + suffix, description)
+        if self.manifest:
+            self._update_manifest(add = [keyname])
 
     def __contains__(self, index):
+        if self._definitely_absent(index):
+            return False
         keyname = self.filename(index)
-        return self.bucket.get_key(keyname) != None
+        return self._retry(lambda: self.bucket.get_key(keyname), hedge = True) != None
 
     class Timeout(socket.timeout):
         pass
 
     def __getitem__(self, index):
+        return self._get(index)[0]
+
+    def _get(self, index):
+        '''
+        Get a value with a single GET, rather than a HEAD with
+        bucket.get_key and then a GET.
+
+        :returns: The value and its Last-Modified time in seconds since
+            the epoch, or None if it came from the local cache
+        '''
         keyname = self.filename(index)
-        key = self.bucket.get_key(keyname)
-        if key:
-            with tempfile.NamedTemporaryFile('w+' + self._b()) as tmp:
-                try:
-                    key.get_contents_to_filename(tmp.name)
-                except socket.timeout:
-                    raise self.__class__.Timeout('Timeout when reading from S3')
+        try:
+            if self.local_cache:
+                return self._get_local(keyname), None
+            key, buf = self._fetch(keyname)
+            with buf:
+                return self._load(buf), _timestamp(key.last_modified)
+        except socket.timeout:
+            raise self.__class__.Timeout('Timeout when reading from S3')
+        except S3ResponseError as e:
+            if _not_found(e):
+                self._forget_local(keyname)
+                raise KeyError(keyname)
+            raise
+
+    def _fetch(self, keyname, headers = {}):
+        '''
+        Download a key into a new spooled buffer, with retries and hedging;
+        each attempt gets its own buffer.
+
+        :returns: The key and the buffer, rewound
+        '''
+        def attempt():
+            buf = self._spool()
+            try:
+                key = self._download(keyname, buf, headers)
+            except:
+                buf.close()
+                raise
+            buf.seek(0)
+            return key, buf
+        # The other attempt's buffer is closed when it finishes.
+        return self._retry(attempt, hedge = True, discard = lambda result: result[1].close())
+
+    def _download(self, keyname, buf, headers = {}):
+        '''
+        Download a key into a buffer. The first request asks for the first
+        multipart_threshold bytes, which is usually the whole value;
+        the rest of larger values is downloaded in parallel ranges.
+
+        :returns: The key, with the size and etag from the first response
+        '''
+        key = self.bucket.new_key(keyname)
+        try:
+            first = dict(headers, **_range(0, self.multipart_threshold))
+            key.get_contents_to_file(buf, headers = first)
+        except S3ResponseError as e:
+            if e.status == 416: # Empty keys have no satisfiable range.
+                key.get_contents_to_file(buf, headers = dict(headers))
+                return key
+            raise
 
-                tmp.file.seek(0)
+        if key.size != None and key.size > self.multipart_threshold:
+            def get_range(start):
+                headers = _range(start, self.part_size)
+                # Fail rather than mixing two versions of the value.
+                if key.etag:
+                    headers['If-Match'] = key.etag
+                return self.bucket.new_key(keyname).get_contents_as_string(headers = headers)
 
+            starts = range(self.multipart_threshold, key.size, self.part_size)
+            for _, chunk in read_ahead(get_range, starts, self.transfer_workers,
+                                       executor = self._transfer_executor()):
+                buf.write(chunk)
+        return key
+
+    def _local_filename(self, keyname):
+        return os.path.join(self.local_cache, self.bucketname, *keyname.split('/'))
+
+    def _get_local(self, keyname):
+        '''
+        Load a value from the local cache, downloading it only if it has
+        changed. Each cached file is the ETag, a newline, and then the value.
+        '''
+        fn = self._local_filename(keyname)
+        try:
+            fp = open(fn, 'rb')
+        except OpenError:
+            return self._fetch_local(keyname, fn, {})
+
+        with fp:
+            etag = fp.readline()[:-1].decode('utf-8')
+            if time.time() - os.fstat(fp.fileno()).st_mtime >= self.freshness:
                 try:
-                    value = self.serializer.load(tmp.file)
-                except FileNotFoundError:
-                    raise self.__class__.Timeout('Timeout when reading from S3')
+                    return self._fetch_local(keyname, fn, {'If-None-Match': etag})
+                except S3ResponseError as e:
+                    if e.status != 304:
+                        raise
+                # Not modified
+                os.utime(fn)
+            return self._load(fp)
 
-            return value
-        else:
+    def _fetch_local(self, keyname, fn, headers):
+        key, buf = self._fetch(keyname, headers)
+        with buf:
+            tmp = mktemp(os.path.join(self.local_cache, '.tmp'))
+            with open(tmp, 'wb') as fp:
+                fp.write((key.etag or '').encode('utf-8') + b'\n')
+                shutil.copyfileobj(buf, fp)
+            os.makedirs(os.path.dirname(fn), exist_ok = True)
+            os.rename(tmp, fn)
+            buf.seek(0)
+            return self._load(buf)
+
+    def _forget_local(self, keyname):
+        if self.local_cache:
+            try:
+                os.remove(self._local_filename(keyname))
+            except DeleteError:
+                pass
+
+    def _lookup(self, index):
+        if self._definitely_absent(index):
+            raise KeyError(index)
+        return self[index]
+
+    def _lookup_dated(self, index):
+        if self._definitely_absent(index):
+            raise KeyError(index)
+        value, mtime = self._get(index)
+        if mtime == None:
+            # The local cache doesn't keep the date.
+            mtime = self._mtime(index)
+        return value, mtime
+
+    def _mtime(self, index):
+        keyname = self.filename(index)
+        key = self._retry(lambda: self.bucket.get_key(keyname), hedge = True)
+        if key == None:
             raise KeyError(keyname)
+        return _timestamp(key.last_modified)
 
-    def keys(self):
+    def get_range(self, index, offset, length = None):
+        '''
+        Read part of the serialized value for a key with an HTTP range request.
+        '''
+        keyname = self.filename(index)
+        if length == None:
+            headers = {'Range': 'bytes=%d-' % offset}
+        elif length == 0:
+            return b''
+        else:
+            headers = _range(offset, length)
+        try:
+            return self._retry(lambda: self.bucket.new_key(keyname).get_contents_as_string(headers = headers),
+                               hedge = True)
+        except socket.timeout:
+            raise self.__class__.Timeout('Timeout when reading from S3')
+        except S3ResponseError as e:
+            if _not_found(e):
+                raise KeyError(keyname)
+            elif e.status == 416: # The offset is past the end.
+                return b''
+            raise
+
+    def open_read(self, index):
+        '''
+        Open the serialized value for a key as a readable binary stream
+        that downloads as it is read.
+        '''
+        keyname = self.filename(index)
+        def open_key():
+            key = self.bucket.new_key(keyname)
+            key.open_read()
+            return key
+        try:
+            # Not hedged, because the slower response would be left open.
+            key = self._retry(open_key)
+        except socket.timeout:
+            raise self.__class__.Timeout('Timeout when reading from S3')
+        except S3ResponseError as e:
+            if _not_found(e):
+                raise KeyError(keyname)
+            raise
+        return io.BufferedReader(_KeyReader(key, self.__class__.Timeout))
+
+    def _write_sidecar(self, keyname, text):
+        self._retry(lambda: self.bucket.new_key(keyname).set_contents_from_string(text))
+
+    def _read_sidecar(self, keyname):
+        try:
+            payload = self._retry(lambda: self.bucket.new_key(keyname).get_contents_as_string(), hedge = True)
+        except S3ResponseError as e:
+            if _not_found(e):
+                return None
+            raise
+        return payload.decode('utf-8')
+
+    def _sizes(self):
         for k in self.bucket.list(prefix = self.base_directory):
-            index = self.from_filename(k.name)
+            if not self._is_special(k.name) and self.from_filename(k.name) != None:
+                yield k.name, k.size
+
+    def _filenames(self):
+        if self.manifest:
+            return self._read_manifest()
+        else:
+            return self._list()
+
+    def keys(self):
+        for keyname in self._filenames():
+            index = self.from_filename(keyname)
             if index != None:
                 yield index
 
+    def _list(self):
+        for k in self.bucket.list(prefix = self.base_directory):
+            if not self._is_special(k.name):
+                yield k.name
+
+    def _read_manifest(self):
+        '''
+        Get the key names from the manifest and from the updates written
+        since, making the manifest from a listing if it does not exist yet.
+        If this S3Vlermv is mutable, updates older than manifest_grace are
+        compacted into the manifest, and those that were already in the
+        manifest that was read are deleted once it is older than
+        manifest_grace; otherwise, reading writes nothing.
+        '''
+        keyname = self.base_directory + self.manifest_name
+        try:
+            # Each attempt makes its key in its own thread, with that thread's connection.
+            payload = self._retry(lambda: self.bucket.new_key(keyname).get_contents_as_string(), hedge = True)
+        except S3ResponseError as e:
+            if not _not_found(e):
+                raise
+            if self.mutable:
+                return self.resync()
+            return sorted(name for name in self._list() if self.from_filename(name) != None)
+        manifest = json.loads(zlib.decompress(payload).decode('utf-8'))
+        if isinstance(manifest, list):
+            # Written before there were updates
+            manifest = {'keynames': manifest, 'through': '', 'written': 0}
+
+        now = time.time()
+        updates = self._manifest_updates()
+        settled = self._settled(updates, now)
+        keynames = set(manifest['keynames'])
+        through = compacted = None
+        def get_update(name):
+            try:
+                payload = self._retry(lambda: self.bucket.new_key(name).get_contents_as_string(), hedge = True)
+            except S3ResponseError as e:
+                if _not_found(e):
+                    return None # compacted and deleted by another process
+                raise
+            return json.loads(payload.decode('utf-8'))
+        new = [name for name in updates if name > manifest['through']]
+        for name, update in read_ahead(get_update, new, self.transfer_workers,
+                                       executor = self._transfer_executor()):
+            # Settled updates sort first, so the keys to compact are
+            # copied once, before the first unsettled update.
+            if self.mutable and name > settled and through != None and compacted == None:
+                compacted = set(keynames)
+            if update == None:
+                continue
+            keynames.update(update['add'])
+            keynames.difference_update(update['remove'])
+            if name <= settled:
+                through = name
+        if compacted == None:
+            compacted = keynames
+
+        if self.mutable:
+            if through != None:
+                self._write_manifest(compacted, through)
+            if now - manifest['written'] > self.manifest_grace:
+                old = [name for name in updates if name <= manifest['through']]
+                if old:
+                    self._delete_batches(old)
+        return sorted(keynames)
+
+    def _write_manifest(self, keynames, through = ''):
+        manifest = {'keynames': sorted(keynames), 'through': through, 'written': time.time()}
+        payload = zlib.compress(json.dumps(manifest).encode('utf-8'))
+        keyname = self.base_directory + self.manifest_name
+        self._retry(lambda: self.bucket.new_key(keyname).set_contents_from_string(payload, replace = True))
+
+    def _manifest_updates(self):
+        '''
+        :returns: The names of the updates to the manifest, oldest first,
+            skipping other objects under their prefix
+        '''
+        return sorted(k.name for k in self.bucket.list(prefix = self._manifest_updates_prefix())
+                      if self._update_time(k.name) != None)
+
+    def _update_time(self, name):
+        ':returns: The time in the name of an update, in seconds since the epoch, or None'
+        try:
+            return int(name[len(self._manifest_updates_prefix()):].split('-')[0]) / 1e9
+        except ValueError:
+            return None
+
+    def _settled(self, updates, now):
+        ':returns: The name of the newest update older than manifest_grace, or \'\''
+        settled = ''
+        for name in updates:
+            written = self._update_time(name)
+            if written != None and written < now - self.manifest_grace:
+                settled = name
+        return settled
+
+    def _update_manifest(self, add = (), remove = ()):
+        '''
+        Record keys that were added or removed, in a new object rather than
+        by rewriting the manifest, so that writes take one small PUT and
+        writers in different processes don't overwrite each other's updates.
+        Names start with the time, so they sort in the order of the updates.
+        '''
+        name = '%s%020d-%s' % (self._manifest_updates_prefix(), time.time_ns(), _random_file_name())
+        payload = json.dumps({'add': sorted(add), 'remove': sorted(remove)})
+        self._retry(lambda: self.bucket.new_key(name).set_contents_from_string(payload))
+
+    def resync(self):
+        '''
+        Rebuild the manifest from a full listing of the prefix;
+        use this if something other than this S3Vlermv added or deleted keys.
+
+        :returns: The key names in the manifest
+        '''
+        # Updates written since the listing started are applied on top.
+        through = self._settled(self._manifest_updates(), time.time())
+        keynames = sorted(name for name in self._list() if self.from_filename(name) != None)
+        self._write_manifest(keynames, through)
+        return keynames
+
     def __delitem__(self, index):
         super(S3Vlermv, self).__delitem__(index)
         keyname = self.filename(index)
-        self.bucket.delete_key(keyname)
+        self._retry(lambda: self.bucket.delete_key(keyname))
+        self._forget_local(keyname)
+        for extra in self._extra_keynames(keyname):
+            self._retry(lambda: self.bucket.delete_key(extra))
+        if self.manifest:
+            self._update_manifest(remove = [keyname])
+
+    def delete_many(self, indices):
+        '''
+        Delete many keys at once, with one multi-object delete request
+        per thousand keys; keys that don't exist are skipped.
+        The manifest is updated once at the end.
+
+        :raises EnvironmentError: If S3 fails to delete some keys
+            (The rest are still deleted.)
+        '''
+        self._check_delitem()
+        self._delete_filenames(self.filename(index) for index in indices)
+
+    def _delete_filenames(self, keynames):
+        self._delete_keys([name for keyname in keynames
+                           for name in [keyname] + self._extra_keynames(keyname)])
+
+    def _extra_keynames(self, keyname):
+        'The sidecars and cost record that may go with a value'
+        # Whether or not this vlermv records costs, the one that saved keyname may have.
+        return [keyname + suffix for suffix in self._sidecar_suffixes()] + [self._cost_filename(keyname)]
+
+    def clear(self):
+        '''
+        Delete everything under the prefix, including the manifest,
+        with multi-object delete requests.
+        '''
+        self._check_delitem()
+        self._delete_keys([key.name for key in self.bucket.list(prefix = self.base_directory)])
+        if self.bloom_filter != None:
+            self.bloom_filter.clear()
+
+    def _delete_batches(self, keynames):
+        ':returns: The errors from the multi-object delete requests'
+        errors = []
+        for i in range(0, len(keynames), self.delete_batch_size):
+            batch = keynames[i:i + self.delete_batch_size]
+            result = self._retry(lambda: self.bucket.delete_keys(batch, quiet = True))
+            errors.extend(result.errors)
+        return errors
+
+    def _delete_keys(self, keynames):
+        errors = self._delete_batches(keynames)
+        for keyname in keynames:
+            self._forget_local(keyname)
+        manifest_keyname = self.base_directory + self.manifest_name
+        if self.manifest and manifest_keyname not in keynames:
+            self._update_manifest(remove = keynames)
+
+        if errors:
+            msg = 'Could not delete %d keys, including %s (%s)'
+            raise EnvironmentError(msg % (len(errors), errors[0].key, errors[0].message))
 
     def __len__(self):
         return sum(1 for _ in self.keys())
@@ -0,0 +1,26 @@
+class S3Layout:
+    '''
+    Names of the objects other than values and sidecars that
+    :py:class:`~vlermv.S3Vlermv` keeps under its prefix,
+    shared with :py:class:`~vlermv.AsyncS3Vlermv` without importing boto
+    '''
+
+    #: Name of the manifest object, relative to the prefix; updates to it
+    #: are written under this name plus ``.d/``.
+    manifest_name = '.vlermv-manifest'
+
+    #: Name of the object that holds the inflation for :py:meth:`evict`,
+    #: relative to the prefix
+    inflation_name = '.vlermv-inflation'
+
+    def _inflation_filename(self):
+        return self.base_directory + self.inflation_name
+
+    def _manifest_updates_prefix(self):
+        return self.base_directory + self.manifest_name + '.d/'
+
+    def _is_special(self, keyname):
+        'Is this object under the prefix something other than a value or sidecar?'
+        return keyname in {self.base_directory + self.manifest_name, self._inflation_filename()} \
+            or keyname.startswith(self.base_directory + self.cost_directory + '/') \
+            or keyname.startswith(self._manifest_updates_prefix())
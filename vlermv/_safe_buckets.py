@@ -1,26 +1,107 @@
-from time import sleep
-import threading, queue
+import os, threading, weakref
+from concurrent.futures import Future
 
-from boto import connect_s3
+def _connect_s3(keep_alive = None):
+    import boto, boto.connection
+    if keep_alive != None:
+        boto.connection.ConnectionPool.STALE_DURATION = keep_alive
+    return boto.connect_s3()
 
-def create_buckets(create_bucket, log, state):
-    while True:
-        bucketname = log.get()
-        state[bucketname] = create_bucket(bucketname)
+#: Every SafeBuckets, to reset in forked children
+_instances = weakref.WeakSet()
+
+def _after_fork():
+    for instance in list(_instances):
+        instance._after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child = _after_fork)
 
 class SafeBuckets:
     '''
     Thread-safely create a bucket.
+
+    Each bucket is created only once; the first thread to ask for a bucket
+    creates it, other threads asking for the same bucket meanwhile wait for
+    that, and buckets that already exist are returned without waiting.
+
+    boto connections must not be shared between threads, so each thread
+    gets its own connection (see :py:meth:`local`). Each connection keeps
+    its HTTP connections alive for reuse.
+
+    :param create_bucket: Function that creates a bucket from its name;
+        by default, the calling thread's connection creates it.
+    :param connect: Function that makes a new S3 connection
+    :param float keep_alive: Seconds to keep idle HTTP connections open
+        for reuse; this sets boto's process-wide ``connection_stale_duration``.
     '''
-    def __init__(self, create_bucket = connect_s3().create_bucket):
-        self.log = queue.Queue()
+    def __init__(self, create_bucket = None, connect = None, keep_alive = None):
+        if connect == None:
+            connect = lambda: _connect_s3(keep_alive)
+        if create_bucket == None:
+            create_bucket = lambda bucketname: self.connection().create_bucket(bucketname)
+        self.connect = connect
+        self.create_bucket = create_bucket
         self.state = {}
-        creator = threading.Thread(target = create_buckets,
-           args = (create_bucket, self.log, self.state), daemon = True)
-        creator.start()
+        self._after_fork()
+        _instances.add(self)
+
+    def _after_fork(self):
+        # A lock held by another thread at fork time would never be released
+        # in the child, and the threads creating pending buckets don't exist.
+        self._lock = threading.Lock()
+        self._pending = {}
+        # Connections inherited from the parent share its sockets.
+        self._local = threading.local()
+
+    def connection(self):
+        'Get the S3 connection for the current thread.'
+        connection = getattr(self._local, 'connection', None)
+        if connection == None:
+            connection = self._local.connection = self.connect()
+            self._local.buckets = {}
+        return connection
+
+    def local(self, k):
+        '''
+        Get a bucket, creating it if necessary, bound to the current thread's
+        connection. Unlike the bucket from ``self[k]``, this is safe to use
+        from any number of threads at once.
+        '''
+        connection = self.connection()
+        buckets = self._local.buckets
+        if k not in buckets:
+            self[k]
+            buckets[k] = connection.get_bucket(k, validate = False)
+        return buckets[k]
 
     def __getitem__(self, k):
-        self.log.put(k)
-        while k not in self.state:
-            sleep(0)
-        return self.state[k]
+        try:
+            return self.state[k]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if k in self.state:
+                return self.state[k]
+            future = self._pending.get(k)
+            creator = future == None
+            if creator:
+                future = self._pending[k] = Future()
+
+        if not creator:
+            return future.result()
+
+        try:
+            bucket = self.create_bucket(k)
+        except BaseException as e:
+            with self._lock:
+                del(self._pending[k])
+            future.set_exception(e)
+            raise
+        else:
+            with self._lock:
+                self.state[k] = bucket
+                del(self._pending[k])
+            future.set_result(bucket)
+            return bucket
@@ -1,4 +1,6 @@
-import os, posixpath
+import os, posixpath, itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 def split(path):
     'Split a path into a tuple of all directories and then the final directory/file.'
@@ -31,6 +33,14 @@ These attributes are available: %s.''' % (x, namespace.__name__, attrs)
     raise AttributeError(msg)
 
 def safe_path(unsafe_path, not_allowed = {'', '.'}):
+    # Paths whose elements are plain names are already safe.
+    for x in unsafe_path:
+        if x in not_allowed or x == '..' or '/' in x:
+            break
+    else:
+        if len(unsafe_path) > 0:
+            return tuple(unsafe_path)
+
     unsafe_str = posixpath.join('', *unsafe_path)
     rough_tuple = posixpath.join('/', posixpath.normpath(unsafe_str)).split('/')[1:]
     safe_tuple = tuple(x for x in rough_tuple if x not in not_allowed)
@@ -41,3 +51,43 @@ def safe_path(unsafe_path, not_allowed = {'', '.'}):
         raise ValueError('Relative paths above the starting directory (./..) are not allowed.')
     else:
         return safe_tuple
+
+def read_ahead(func, iterable, window, workers = None, ordered = True, executor = None):
+    '''
+    Yield ``(x, func(x))`` for each ``x`` in ``iterable``, running ``func``
+    in a thread pool with at most ``window`` calls in flight at once.
+
+    :param int window: Maximum number of calls in flight (and of results
+        held in memory)
+    :param int workers: Number of threads; defaults to ``window``
+    :param bool ordered: Yield results in the order of ``iterable``
+        (True) or in the order that they complete (False)
+    :param executor: A long-lived executor to run func in, rather than
+        a new thread pool (workers is then ignored)
+    '''
+    xs = iter(iterable)
+    own = executor == None
+    if own:
+        executor = ThreadPoolExecutor(max_workers = workers or window)
+    pending = deque()
+    try:
+        pending = deque((x, executor.submit(func, x)) for x in itertools.islice(xs, window))
+        while pending:
+            if ordered:
+                x, future = pending.popleft()
+                done = [(x, future)]
+            else:
+                finished, _ = wait([f for _, f in pending], return_when = FIRST_COMPLETED)
+                done = [(x, f) for x, f in pending if f in finished]
+                pending = deque((x, f) for x, f in pending if f not in finished)
+            for x, future in done:
+                yield x, future.result()
+            for x in itertools.islice(xs, len(done)):
+                pending.append((x, executor.submit(func, x)))
+    finally:
+        if own:
+            executor.shutdown(wait = True, cancel_futures = True)
+        else:
+            for _, future in pending:
+                future.cancel()
+            wait([future for _, future in pending])
@@ -1,6 +1,15 @@
 from ._identity import identity_str, identity_bytes, identity_mmap_str, identity_mmap_bytes
-try:
-    from ._lxml import html, xml
-except ImportError:
-    pass
 from . import pickle, compressed_pickle
+
+def __getattr__(name):
+    # lxml is slow to import and optional, so load it on first access.
+    if name in {'html', 'xml'}:
+        try:
+            from . import _lxml
+        except ImportError as e:
+            raise AttributeError('module %r has no attribute %r (%s)' % (__name__, name, e)) from e
+        if hasattr(_lxml, name):
+            value = getattr(_lxml, name)
+            globals()[name] = value
+            return value
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
@@ -17,9 +17,38 @@ class identity_str(_identity):
     'Dump and load raw strings.'
     binary_mode = False
 
+class LazyBytes:
+    '''
+    Bytes that are read from the vlermv only when sliced. ::
+
+        header = vlermv.lazy('big.tar')[:512]
+    '''
+    def __init__(self, get_range):
+        self.get_range = get_range
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.start or 0, index.stop, index.step
+            if start < 0 or (stop != None and stop < 0):
+                raise ValueError('Lazy slices must not be negative.')
+            length = None if stop == None else max(0, stop - start)
+            data = self.get_range(start, length)
+            return data if step == None else data[::step]
+        elif index < 0:
+            raise ValueError('Lazy indices must not be negative.')
+        else:
+            data = self.get_range(index, 1)
+            if len(data) == 0:
+                raise IndexError('index out of range')
+            return data[0]
+
+    def read(self):
+        return self.get_range(0)
+
 class identity_bytes(_identity):
     'Dump and load raw bytes.'
     binary_mode = True
+    load_lazy = LazyBytes
 
 class identity_mmap_bytes(_identity):
     'Dump and load raw bytes, loading with a memory-mapped file.'
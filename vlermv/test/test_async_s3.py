@@ -0,0 +1,217 @@
+import asyncio, json, hashlib
+
+import pytest
+
+from .._async_s3 import AsyncS3Vlermv
+from ..serializers import identity_bytes
+from ..transformers import hashed
+
+class FakeClientError(Exception):
+    'Like botocore.exceptions.ClientError'
+    def __init__(self, code):
+        self.response = {'Error': {'Code': code}}
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+        self.closed = False
+    async def read(self):
+        return self.data
+    def close(self):
+        self.closed = True
+
+class FakePaginator:
+    def __init__(self, client, page_size):
+        self.client = client
+        self.page_size = page_size
+    async def paginate(self, Bucket, Prefix = ''):
+        names = sorted(k for k in self.client.db if k.startswith(Prefix))
+        for i in range(0, len(names), self.page_size):
+            await asyncio.sleep(0)
+            yield {'Contents': [{'Key': name} for name in names[i:i + self.page_size]]}
+
+class FakeClient:
+    'Like an aiobotocore S3 client'
+    def __init__(self, page_size = 2, **db):
+        self.db = db
+        self.page_size = page_size
+        self.requests = []
+        self.in_flight = self.max_in_flight = 0
+    async def _request(self, method):
+        self.requests.append(method)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+    async def get_object(self, Bucket, Key):
+        await self._request('GET')
+        if Key not in self.db:
+            raise FakeClientError('NoSuchKey')
+        return {'Body': FakeBody(self.db[Key])}
+    async def head_object(self, Bucket, Key):
+        await self._request('HEAD')
+        if Key not in self.db:
+            raise FakeClientError('404')
+        return {'ETag': '"%s"' % hashlib.md5(self.db[Key]).hexdigest()}
+    async def put_object(self, Bucket, Key, Body):
+        await self._request('PUT')
+        self.db[Key] = Body
+    async def delete_object(self, Bucket, Key):
+        await self._request('DELETE')
+        self.db.pop(Key, None)
+    async def delete_objects(self, Bucket, Delete):
+        await self._request(('DELETE', len(Delete['Objects'])))
+        for obj in Delete['Objects']:
+            self.db.pop(obj['Key'], None)
+        return {}
+    def get_paginator(self, name):
+        assert name == 'list_objects_v2'
+        return FakePaginator(self, self.page_size)
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def test_get_set():
+    client = FakeClient()
+    v = AsyncS3Vlermv('bucket', 'prefix', client = client, serializer = json)
+    run(v.set('a', {'b': 3}))
+    assert client.db == {'prefix/a': b'{"b": 3}'}
+    assert run(v.get('a')) == {'b': 3}
+    assert run(v.get('z')) == None
+    assert run(v.get('z', 8)) == 8
+    with pytest.raises(KeyError):
+        run(v.getitem('z'))
+
+def test_contains_delete():
+    client = FakeClient(**{'prefix/a': b'x'})
+    v = AsyncS3Vlermv('bucket', 'prefix', client = client, serializer = identity_bytes)
+    assert run(v.contains('a'))
+    assert not run(v.contains('z'))
+    run(v.delete('a'))
+    assert not run(v.contains('a'))
+
+def test_other_errors():
+    class BrokenClient(FakeClient):
+        async def get_object(self, Bucket, Key):
+            raise FakeClientError('AccessDenied')
+    v = AsyncS3Vlermv('bucket', client = BrokenClient(), serializer = identity_bytes)
+    with pytest.raises(FakeClientError):
+        run(v.get('a'))
+
+def test_keys():
+    client = FakeClient(page_size = 2, **{'p/a': b'', 'p/b': b'', 'p/c': b'',
+                                          'p/.vlermv-manifest': b'', 'q/d': b''})
+    v = AsyncS3Vlermv('bucket', 'p', client = client, serializer = identity_bytes)
+    async def keys():
+        return [key async for key in v]
+    assert run(keys()) == [('a',), ('b',), ('c',)]
+    assert run(v.count()) == 3
+
+def test_keys_shared_with_s3vlermv():
+    pytest.importorskip('boto')
+    from .._s3 import S3Vlermv
+    from .test_s3 import FakeBucket
+    fakebucket = FakeBucket('bucket')
+    d = S3Vlermv('bucket', 'p', bucket = fakebucket, serializer = identity_bytes,
+                 manifest = True, record_cost = True)
+    d.func = lambda x: x.encode('utf-8')
+    d('a')
+    d('b')
+    d.evict(0)
+    d('a')
+    assert any(k.startswith('p/.vlermv-manifest.d/') for k in fakebucket.db)
+    assert 'p/.vlermv-costs/a' in fakebucket.db
+    assert 'p/.vlermv-inflation' in fakebucket.db
+
+    v = AsyncS3Vlermv('bucket', 'p', client = FakeClient(**fakebucket.db), serializer = identity_bytes)
+    async def keys():
+        return [key async for key in v]
+    assert run(keys()) == [('a',)]
+    assert run(v.count()) == 1
+
+def test_many():
+    client = FakeClient()
+    v = AsyncS3Vlermv('bucket', client = client, serializer = identity_bytes, concurrency = 10)
+    run(v.set_many({str(i): b'%d' % i for i in range(100)}))
+    assert client.max_in_flight == 10
+    assert run(v.get_many(['1', '2', 'z'])) == [b'1', b'2', None]
+
+    del(client.requests[:])
+    run(v.delete_many(str(i) for i in range(50)))
+    assert client.requests == [('DELETE', 50)]
+    assert len(client.db) == 50
+
+def test_gather():
+    client = FakeClient()
+    v = AsyncS3Vlermv('bucket', client = client, serializer = identity_bytes)
+    async def main():
+        await asyncio.gather(*(v.set(str(i), b'') for i in range(200)))
+    run(main())
+    assert client.max_in_flight == 200
+
+def test_clear():
+    client = FakeClient(**{'p/%d' % i: b'' for i in range(5)})
+    client.db['q/a'] = b''
+    v = AsyncS3Vlermv('bucket', 'p', client = client, serializer = identity_bytes,
+                      delete_batch_size = 2)
+    run(v.clear())
+    assert list(client.db) == ['q/a']
+    assert client.requests.count(('DELETE', 2)) == 2
+
+def test_sidecar():
+    client = FakeClient()
+    v = AsyncS3Vlermv('bucket', client = client, serializer = identity_bytes,
+                      key_transformer = hashed(sidecar = True))
+    run(v.set(('a', 1), b'x'))
+    assert len(client.db) == 2
+    assert run(v.count()) == 1
+    run(v.delete(('a', 1)))
+    assert client.db == {}
+
+def test_immutable():
+    client = FakeClient(a = b'x')
+    v = AsyncS3Vlermv('bucket', client = client, serializer = identity_bytes, mutable = False)
+    with pytest.raises(PermissionError):
+        run(v.set('a', b'y'))
+    with pytest.raises(PermissionError):
+        run(v.delete('a'))
+    run(v.set('b', b'y'))
+
+def test_memoize():
+    client = FakeClient()
+    calls = []
+    @AsyncS3Vlermv.memoize('bucket', client = client, serializer = json)
+    async def f(x):
+        calls.append(x)
+        return x * 2
+    assert run(f(3)) == 6
+    assert run(f(3)) == 6
+    assert calls == [3]
+
+@pytest.mark.parametrize('kwargs', [
+    {'cache_exceptions': True}, {'record_cost': True}, {'ttl': 60},
+    {'error_ttl': 60}, {'stale_while_revalidate': 60},
+])
+def test_unsupported_memoize_options(kwargs):
+    with pytest.raises(TypeError):
+        AsyncS3Vlermv('bucket', client = FakeClient(), **kwargs)
+
+def test_no_memoize_batch():
+    with pytest.raises(TypeError):
+        AsyncS3Vlermv.memoize_batch('bucket', client = FakeClient())
+
+def test_no_sync_api():
+    v = AsyncS3Vlermv('bucket', client = FakeClient())
+    with pytest.raises(TypeError):
+        v['a']
+    with pytest.raises(TypeError):
+        'a' in v
+
+def test_skip_unchanged():
+    client = FakeClient()
+    v = AsyncS3Vlermv('bucket', client = client, serializer = json, skip_unchanged = True)
+    run(v.set('a', 1))
+    run(v.set('a', 1))
+    run(v.set('a', 2))
+    assert client.db == {'a': b'2'}
+    assert client.requests == ['HEAD', 'PUT', 'HEAD', 'HEAD', 'PUT']
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from .._bloom import BloomFilter
+
+def test_no_false_negatives(tmpdir):
+    bloom = BloomFilter(str(tmpdir.join('bloom')), capacity = 1000)
+    for i in range(1000):
+        bloom.add('key-%d' % i)
+    assert all(('key-%d' % i) in bloom for i in range(1000))
+
+def test_false_positive_rate(tmpdir):
+    bloom = BloomFilter(str(tmpdir.join('bloom')), capacity = 1000, error_rate = 0.01)
+    for i in range(1000):
+        bloom.add('key-%d' % i)
+    false_positives = sum(('other-%d' % i) in bloom for i in range(10000))
+    assert false_positives < 300
+
+def test_persistent(tmpdir):
+    filename = str(tmpdir.join('a', 'bloom'))
+    bloom = BloomFilter(filename, capacity = 100)
+    bloom.add(b'abc')
+    bloom.close()
+
+    # The existing file's parameters win.
+    bloom = BloomFilter(filename, capacity = 10**6)
+    assert b'abc' in bloom
+    assert 'abc' in bloom
+    assert 'def' not in bloom
+    assert os.path.getsize(filename) < 1000
+
+def test_shared(tmpdir):
+    filename = str(tmpdir.join('bloom'))
+    a = BloomFilter(filename)
+    b = BloomFilter(filename)
+    a.add('abc')
+    assert 'abc' in b
+
+def test_clear(tmpdir):
+    bloom = BloomFilter(str(tmpdir.join('bloom')))
+    bloom.add('abc')
+    bloom.clear()
+    assert 'abc' not in bloom
+
+def test_not_a_bloom_filter(tmpdir):
+    filename = tmpdir.join('bloom')
+    filename.write('not a Bloom filter')
+    with pytest.raises(ValueError):
+        BloomFilter(str(filename))
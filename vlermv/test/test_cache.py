@@ -1,12 +1,12 @@
 '''
 These tests will be better off somewhere else in the code.
 '''
-import os, pickle, shutil, json
+import os, pickle, shutil, json, threading, time
 from tempfile import mkdtemp
 
 import pytest
 
-from ..transformers import tuple as _tuple
+from ..transformers import tuple as _tuple, hashed
 from .._fs import Vlermv
 
 def test_new_success():
@@ -168,3 +168,403 @@ def test_cache_exceptions_save_type():
     first = f('x')
     second = f('x')
     assert first == second == 3
+
+def test_key_kwargs():
+    tmp = mkdtemp()
+    calls = []
+
+    @Vlermv.memoize(tmp, key_kwargs = True, key_transformer = hashed())
+    def f(x, y = 1):
+        calls.append((x, y))
+        return x * y
+
+    assert f(2) == 2
+    assert f(2, y = 3) == 6
+    assert f(2, y = 3) == 6
+    assert calls == [(2, 1), (2, 3)]
+
+def test_kwargs_not_in_key():
+    tmp = mkdtemp()
+
+    @Vlermv.memoize(tmp)
+    def f(x, y = 1):
+        return x * y
+
+    assert f(2, y = 3) == 6
+    assert f(2, y = 4) == 6
+
+def test_content_hash_sidecar():
+    tmp = mkdtemp()
+    transformer = hashed(sidecar = True)
+
+    @Vlermv.memoize(tmp, key_kwargs = True, key_transformer = transformer)
+    def f(text, n = 1):
+        return len(text) * n
+
+    long_text = 'abc ' * 10000
+    assert f(long_text, n = 2) == 80000
+
+    digest, = f.keys()
+    fn = f.filename(((long_text,), (('n', 2),)))
+    assert fn.endswith(digest)
+    with open(fn + '.key') as fp:
+        assert fp.read() == repr(((long_text,), (('n', 2),))) + '\n'
+    assert len(f) == 1
+
+    del(f[((long_text,), (('n', 2),))])
+    assert not os.path.exists(fn + '.key')
+    assert len(f) == 0
+
+def _square(x):
+    # At the top level, so that processes can run it
+    return x * x, os.getpid()
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_map(tmpdir, executor):
+    square = Vlermv.memoize(str(tmpdir))(_square)
+    square[(3,)] = 'cached'
+    observed = list(square.map(range(6), workers = 2, executor = executor))
+    assert observed[3] == 'cached'
+    assert [y for y, _ in observed[:3] + observed[4:]] == [0, 1, 4, 16, 25]
+    if executor == 'process':
+        assert os.getpid() not in {pid for _, pid in observed[:3] + observed[4:]}
+    assert square[(5,)] == observed[5]
+
+def test_map_bounded(tmpdir):
+    release = threading.Event()
+    calls = []
+    @Vlermv.memoize(str(tmpdir))
+    def f(x):
+        calls.append(x)
+        if x == 0:
+            assert release.wait(5)
+        return x
+    results = f.map(range(100), workers = 2)
+    first = []
+    thread = threading.Thread(target = lambda: first.append(next(results)))
+    thread.start()
+    time.sleep(0.2)
+    # Waiting for the first result, so only a few more are computed
+    assert len(calls) <= 4
+    release.set()
+    thread.join()
+    assert first + list(results) == list(range(100))
+
+def test_map_only_misses():
+    tmp = mkdtemp()
+    calls = []
+    @Vlermv.memoize(tmp, key_kwargs = True, key_transformer = hashed())
+    def add(x, y):
+        calls.append((x, y))
+        return x + y
+    assert add(1, 2) == 3
+    assert list(add.map([1, 2, 3], [2, 3, 4], workers = 2)) == [3, 5, 7]
+    assert sorted(calls) == [(1, 2), (2, 3), (3, 4)]
+    assert add(3, 4) == 7
+    assert len(calls) == 3
+
+def test_map_exceptions():
+    tmp = mkdtemp()
+    @Vlermv.memoize(tmp, cache_exceptions = True)
+    def invert(x):
+        return 1 / x
+    results = invert.map([1, 0, 2])
+    assert next(results) == 1
+    with pytest.raises(ZeroDivisionError):
+        next(results)
+    with pytest.raises(ZeroDivisionError):
+        invert(0)
+
+def test_map_errors():
+    tmp = mkdtemp()
+    with pytest.raises(NotImplementedError):
+        list(Vlermv(tmp).map([1]))
+    square = Vlermv.memoize(tmp)(lambda x: x * x)
+    with pytest.raises(ValueError):
+        list(square.map([1], executor = 'fiber'))
+    with pytest.raises(ValueError):
+        list(square.map([1], executor = 'process'))
+
+class FakeArray:
+    'Like a NumPy array'
+    def __init__(self, values):
+        self.values = list(values)
+    def tolist(self):
+        return list(self.values)
+    def __getitem__(self, positions):
+        return FakeArray(self.values[i] for i in positions)
+
+def test_memoize_batch():
+    tmp = mkdtemp()
+    batches = []
+    @Vlermv.memoize_batch(tmp)
+    def double(xs):
+        batches.append(xs)
+        return [x * 2 for x in xs]
+    assert double([1, 2, 3]) == [2, 4, 6]
+    assert double([3, 4, 4, 1]) == [6, 8, 8, 2]
+    assert batches == [[1, 2, 3], [4]]
+    assert double([]) == []
+    assert len(batches) == 2
+
+    # Same keys as memoize
+    @Vlermv.memoize(tmp)
+    def single(x):
+        raise AssertionError('This should not run.')
+    assert single(4) == 8
+
+def test_memoize_batch_array():
+    tmp = mkdtemp()
+    batches = []
+    @Vlermv.memoize_batch(tmp, key_kwargs = True, key_transformer = hashed())
+    def scale(xs, factor = 1):
+        assert isinstance(xs, FakeArray)
+        batches.append(xs.tolist())
+        return FakeArray(x * factor for x in xs.values).values
+    assert scale(FakeArray([1, 2]), factor = 10) == [10, 20]
+    assert scale(FakeArray([2, 3]), factor = 10) == [20, 30]
+    assert scale(FakeArray([2]), factor = 100) == [200]
+    assert batches == [[1, 2], [3], [2]]
+
+def test_memoize_batch_wrong_length():
+    tmp = mkdtemp()
+    @Vlermv.memoize_batch(tmp)
+    def broken(xs):
+        return [1]
+    with pytest.raises(ValueError):
+        broken([1, 2])
+    assert list(broken.keys()) == []
+
+def _age(vlermv, key, seconds):
+    fn = vlermv.filename(key)
+    t = os.path.getmtime(fn) - seconds
+    os.utime(fn, (t, t))
+
+def test_ttl():
+    tmp = mkdtemp()
+    calls = []
+    @Vlermv.memoize(tmp, ttl = 60)
+    def f(x):
+        calls.append(x)
+        return len(calls)
+    assert f('a') == 1
+    assert f('a') == 1
+    _age(f, ('a',), 120)
+    assert f('a') == 2
+    assert calls == ['a', 'a']
+    assert f.get(('a',)) == 2
+
+def test_ttl_skip_unchanged():
+    tmp = mkdtemp()
+    calls = []
+    @Vlermv.memoize(tmp, ttl = 60, skip_unchanged = True)
+    def f(x):
+        calls.append(x)
+        return 'same'
+    assert f('a') == 'same'
+    _age(f, ('a',), 120)
+    assert f('a') == 'same'
+    # The identical value isn't written, but it is fresh again.
+    assert f('a') == 'same'
+    assert calls == ['a', 'a']
+
+@pytest.mark.parametrize('ttl', [None, 60])
+def test_prefix_keys(ttl):
+    @Vlermv.memoize(mkdtemp(), ttl = ttl)
+    def f(*args):
+        return len(args)
+    assert f('x', 'y') == 2
+    # Looking up keys that a file or directory is in the way of is a miss.
+    assert f._try_lookup(('x',)) == (False, None)
+    assert f._try_lookup(('x', 'y', 'z')) == (False, None)
+
+def test_stale_while_revalidate():
+    tmp = mkdtemp()
+    calls = []
+    release = threading.Event()
+    @Vlermv.memoize(tmp, ttl = 60, stale_while_revalidate = 600)
+    def f(x):
+        calls.append(x)
+        if len(calls) > 1:
+            assert release.wait(5)
+        return len(calls)
+    assert f('a') == 1
+
+    _age(f, ('a',), 120)
+    # Stale values are returned at once, with one refresh at a time.
+    assert f('a') == 1
+    assert f('a') == 1
+    release.set()
+    for _ in range(100):
+        if f._refreshing:
+            time.sleep(0.01)
+    assert calls == ['a', 'a']
+    assert f('a') == 2
+
+    # Too old to return
+    _age(f, ('a',), 1000)
+    assert f('a') == 3
+
+def test_stale_while_revalidate_exception():
+    tmp = mkdtemp()
+    calls = []
+    @Vlermv.memoize(tmp, ttl = 60, stale_while_revalidate = 600, cache_exceptions = True)
+    def f(x):
+        calls.append(x)
+        if len(calls) == 2:
+            raise OSError('upstream flaked')
+        return len(calls)
+    assert f('a') == 1
+
+    _age(f, ('a',), 120)
+    assert f('a') == 1
+    for _ in range(100):
+        if f._refreshing:
+            time.sleep(0.01)
+    assert calls == ['a', 'a']
+    # The failed refresh leaves the stale value.
+    assert f('a') == 1
+
+def test_ttl_map():
+    tmp = mkdtemp()
+    calls = []
+    @Vlermv.memoize(tmp, ttl = 60, stale_while_revalidate = 600)
+    def f(x):
+        calls.append(x)
+        return x
+    assert list(f.map([1, 2])) == [1, 2]
+    _age(f, (1,), 120)
+    assert list(f.map([1, 2])) == [1, 2]
+    assert calls == [1, 2, 1]
+
+def test_record_cost():
+    tmp = mkdtemp()
+    @Vlermv.memoize(tmp, record_cost = True)
+    def f(x):
+        time.sleep(0.02)
+        return x
+    f(1)
+    list(f.map([2]))
+    for x in [1, 2]:
+        with open(os.path.join(tmp, '.vlermv-costs', str(x))) as fp:
+            cost = json.load(fp)
+        assert cost['seconds'] >= 0.02
+        assert cost['inflation'] == 0
+    assert sorted(f.keys()) == [('1',), ('2',)]
+
+    del(f[(1,)])
+    assert os.listdir(os.path.join(tmp, '.vlermv-costs')) == ['2']
+
+def test_evict():
+    tmp = mkdtemp()
+    @Vlermv.memoize(tmp, record_cost = True)
+    def f(x):
+        if x == 'slow':
+            time.sleep(0.05)
+        return 'x' * 100
+    for x in ['fast1', 'slow', 'fast2']:
+        f(x)
+    size = os.path.getsize(f.filename(('slow',)))
+    assert f.evict(3 * size) == 0
+    assert f.evict(size) == 2
+    assert list(f.keys()) == [('slow',)]
+    assert sorted(os.listdir(tmp)) == ['.tmp', '.vlermv-costs', 'slow']
+    assert os.listdir(os.path.join(tmp, '.vlermv-costs')) == ['slow']
+
+    # Values saved after an eviction start from the inflated priority,
+    # so old values eventually go even if they were expensive.
+    with open(os.path.join(tmp, '.tmp', 'inflation')) as fp:
+        inflation = float(fp.read())
+    f('new')
+    with open(os.path.join(tmp, '.vlermv-costs', 'new')) as fp:
+        assert json.load(fp)['inflation'] == inflation
+
+def test_cost_namespace():
+    tmp = mkdtemp()
+    @Vlermv.memoize(tmp, record_cost = True)
+    def f(x):
+        return x
+    f('1')
+    f('report.cost')
+    expected = [('1',), ('report.cost',)]
+    assert sorted(f.keys()) == expected
+
+    # Without record_cost, the costs are still not keys.
+    v = Vlermv(tmp)
+    assert sorted(v.keys()) == expected
+    assert sorted(v.items()) == [(('1',), '1'), (('report.cost',), 'report.cost')]
+
+def test_cost_nested_keys():
+    tmp = mkdtemp()
+    @Vlermv.memoize(tmp, record_cost = True)
+    def f(x, y):
+        return x + y
+    f('a', 'b')
+    assert os.path.exists(os.path.join(tmp, '.vlermv-costs', 'a', 'b'))
+    del(f[('a', 'b')])
+    assert sorted(os.listdir(tmp)) == ['.tmp', '.vlermv-costs']
+    assert os.listdir(os.path.join(tmp, '.vlermv-costs')) == []
+
+def test_evict_without_cost():
+    tmp = mkdtemp()
+    f = Vlermv(tmp)
+    f['a'] = 'aaaa'
+    assert f.evict(0) == 1
+    assert len(f) == 0
+
+def test_evict_other_vlermv():
+    tmp = mkdtemp()
+    f = Vlermv.memoize(tmp, record_cost = True)(lambda x: x)
+    f('a')
+    f('b')
+    # A maintenance script that doesn't record costs itself
+    maintenance = Vlermv(tmp, key_transformer = _tuple)
+    maintenance.delete_many([('a',)])
+    assert maintenance.evict(0) == 1
+    assert len(f) == 0
+    assert os.listdir(os.path.join(tmp, '.vlermv-costs')) == []
+
+class DetailedError(Exception):
+    def __init__(self, message, response = None):
+        super(DetailedError, self).__init__(message)
+        self.response = response
+
+def test_error_ttl():
+    tmp = mkdtemp()
+    calls = []
+    @Vlermv.memoize(tmp, cache_exceptions = True, error_ttl = 60)
+    def f(x):
+        calls.append(x)
+        if len(calls) == 1:
+            raise DetailedError('upstream is down', response = 'a' * 10000)
+        return x
+    with pytest.raises(DetailedError) as first:
+        f('a')
+    assert first.value.response != None
+    with pytest.raises(DetailedError) as second:
+        f('a')
+    assert second.value.args == ('upstream is down',)
+    assert second.value.response == None
+    assert os.path.getsize(f.filename(('a',))) < 1000
+    assert calls == ['a']
+
+    _age(f, ('a',), 120)
+    assert f('a') == 'a'
+    _age(f, ('a',), 120)
+    assert f('a') == 'a'
+    assert calls == ['a', 'a']
+
+def test_cache_exceptions_filter():
+    tmp = mkdtemp()
+    calls = []
+    @Vlermv.memoize(tmp, cache_exceptions = (KeyError, ValueError))
+    def f(x):
+        calls.append(x)
+        raise {'key': KeyError, 'zero': ZeroDivisionError}[x](x)
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            f('key')
+        with pytest.raises(ZeroDivisionError):
+            f('zero')
+    assert calls == ['key', 'zero', 'zero']
+    assert ('zero',) not in f
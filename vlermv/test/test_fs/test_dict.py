@@ -1,4 +1,6 @@
 import os
+import errno
+import io
 import pickle
 import tempfile
 import shutil
@@ -7,7 +9,10 @@ import pytest
 
 from .base import simple_vlermv, Base
 from ..._fs import Vlermv
+from ... import _fs
 from ... import _exceptions as exceptions
+from ...serializers import identity_bytes
+from ...transformers import hashed
 
 class TestVlermv(Base):
     def setup_method(self, method):
@@ -82,6 +87,117 @@ class TestVlermv(Base):
         with pytest.raises(KeyError):
             del(self.w[('not a file',)])
 
+    def test_delete_many(self):
+        for path in [('a', 'b', 'c'), ('a', 'b', 'd'), ('a', 'e'), ('f',)]:
+            self.w[path] = 1
+        self.w.delete_many([('a', 'b', 'c'), ('a', 'b', 'd'), ('f',), ('not a file',)])
+        assert list(self.w.keys()) == [('a', 'e')]
+        assert not os.path.exists(os.path.join(self.directory, 'a', 'b'))
+        assert os.path.exists(os.path.join(self.directory, 'a'))
+
+        self.w.delete_many([('a', 'e')])
+        assert os.listdir(self.directory) == ['.tmp']
+
+    def test_delete_many_trailing_slash(self):
+        w = simple_vlermv(self.directory + os.sep)
+        w[('x', 'y')] = 1
+        w[('z',)] = 1
+        w.delete_many([('x', 'y'), ('z',)])
+        assert os.listdir(self.directory) == ['.tmp']
+        assert os.path.isdir(self.directory)
+
+    def test_prefix_keys(self):
+        self.w[('x', 'y')] = 1
+        for key in [('x',), ('x', 'y', 'z')]:
+            assert self.w.get(key, 'default') == 'default'
+            assert key not in self.w
+            with pytest.raises(KeyError):
+                self.w[key]
+            with pytest.raises(KeyError):
+                self.w.open_read(key)
+
+    def test_clear(self):
+        for i in range(10):
+            self.w[('x', str(i))] = i
+        thread = self.w.clear()
+        assert len(self.w) == 0
+        assert os.listdir(self.directory) == ['.tmp']
+        self.w[('y',)] = 1
+        assert list(self.w.keys()) == [('y',)]
+
+        thread.join()
+        parent, name = os.path.split(self.directory)
+        assert not any(fn.startswith('.%s.deleting-' % name) for fn in os.listdir(parent))
+
+    def test_bloom_filter(self, monkeypatch):
+        w = Vlermv(self.directory, bloom_filter = os.path.join(self.directory, '.tmp', 'bloom'))
+        w['a'] = 1
+        assert 'a' in w
+        assert w.get('a') == 1
+
+        def isfile(fn):
+            raise AssertionError('Missing keys should not be looked up.')
+        monkeypatch.setattr(os.path, 'isfile', isfile)
+        monkeypatch.setattr('builtins.open', isfile)
+        assert 'b' not in w
+        assert w.get('b', 8) == 8
+        monkeypatch.undo()
+
+        # Written without the Bloom filter
+        Vlermv(self.directory)['c'] = 3
+        assert 'c' not in w
+        w.rebuild_bloom_filter()
+        assert 'c' in w
+
+        w.clear().join()
+        assert 'a' not in w
+
+    @pytest.mark.parametrize('workers', [None, 1, 4])
+    def test_keys_parallel(self, workers):
+        paths = [('a', 'b', 'c'), ('a', 'b', 'd'), ('a', 'e'), ('f',), ('g', 'h', 'i', 'j')]
+        for path in paths:
+            self.w[path] = 1
+        with open(os.path.join(self.directory, '.tmp', 'lalala'), 'wb'):
+            pass
+        serial = list(self.w.keys())
+        assert sorted(serial) == sorted(paths)
+        assert list(self.w.keys(workers = workers)) == serial
+        assert sorted(self.w.keys(workers = workers, ordered = False)) == sorted(paths)
+
+        w = Vlermv(self.directory, scan_workers = workers)
+        assert len(w) == len(paths)
+
+    def test_keys_symlink(self):
+        self.w[('a', 'b')] = 1
+        os.symlink(os.path.join(self.directory, 'a'), os.path.join(self.directory, 'c'))
+        assert list(self.w.keys()) == [('a', 'b')]
+
+    def test_keys_relative(self, monkeypatch):
+        monkeypatch.chdir(self.directory)
+        w = simple_vlermv('relative')
+        w[('a', 'b')] = 1
+        assert list(w.keys()) == [('a', 'b')]
+
+    @pytest.mark.parametrize('prefetch', [0, 3])
+    def test_items_disk_order(self, prefetch, monkeypatch):
+        hinted = []
+        if hasattr(os, 'posix_fadvise'):
+            fadvise = os.posix_fadvise
+            def posix_fadvise(fd, offset, length, advice):
+                hinted.append(os.fstat(fd).st_ino)
+                return fadvise(fd, offset, length, advice)
+            monkeypatch.setattr(os, 'posix_fadvise', posix_fadvise)
+
+        w = Vlermv(self.directory, hint_window = 2)
+        for i in range(10):
+            w[('d%d' % (i % 3), str(i))] = i
+        observed = list(w.items(prefetch = prefetch, disk_order = True))
+        assert sorted(observed) == sorted(w.items())
+        inodes = [os.stat(w.filename(key)).st_ino for key, _ in observed]
+        assert inodes == sorted(inodes)
+        if hasattr(os, 'posix_fadvise'):
+            assert hinted == inodes
+
     def test_contains(self):
         assert not ('needle',) in self.w
         with open(os.path.join(self.directory, 'needle'), 'wb'):
@@ -159,6 +275,53 @@ class TestVlermv(Base):
 
         assert observed == expected
 
+    def test_items_prefetch(self):
+        for i in range(20):
+            self.w[(str(i),)] = i
+        expected = list(self.w.items())
+        assert list(self.w.items(prefetch = 4)) == expected
+        assert set(self.w.items(prefetch = 4, workers = 2, ordered = False)) == set(expected)
+        assert list(self.w.values(prefetch = 3)) == [v for _, v in expected]
+
+    def test_open_read(self):
+        self.w[('a', 'b')] = [1, 2, 3]
+        with self.w.open_read(('a', 'b')) as fp:
+            assert pickle.load(fp) == [1, 2, 3]
+        with pytest.raises(KeyError):
+            self.w.open_read(('c',))
+
+    def test_put_stream(self):
+        data = pickle.dumps(list(range(100000)))
+        self.w.put_stream(('big',), io.BytesIO(data))
+        assert self.w[('big',)] == list(range(100000))
+        assert os.listdir(self.w.tempdir) == []
+
+        self.w.appendable = False
+        with pytest.raises(PermissionError):
+            self.w.put_stream(('new',), io.BytesIO(data))
+
+    def test_get_range(self):
+        self.w.put_stream(('a',), io.BytesIO(b'abcdefghij'))
+        assert self.w.get_range(('a',), 0, 3) == b'abc'
+        assert self.w.get_range(('a',), 2) == b'cdefghij'
+        assert self.w.get_range(('a',), 8, 5) == b'ij'
+        assert self.w.get_range(('a',), 20) == b''
+        with pytest.raises(KeyError):
+            self.w.get_range(('b',), 0, 3)
+
+    def test_lazy(self):
+        w = Vlermv(self.directory, serializer = identity_bytes)
+        w['a'] = b'abcdefghij'
+        lazy = w.lazy('a')
+        assert lazy[:3] == b'abc'
+        assert lazy[4:6] == b'ef'
+        assert lazy[9] == ord('j')
+        assert lazy[7:] == b'hij'
+        with pytest.raises(IndexError):
+            lazy[10]
+        with pytest.raises(TypeError):
+            self.w.lazy(('a',))
+
     def test_appendable(self):
         self.w.appendable = True
         self.w[('a',)] = 1
@@ -195,3 +358,75 @@ def test_mkdir(yes):
     Vlermv._mkdir = yes
     if os.path.exists(d):
         shutil.rmtree(d)
+
+@pytest.mark.parametrize('xattr', [True, False])
+def test_skip_unchanged(monkeypatch, xattr):
+    if not xattr:
+        monkeypatch.delattr(os, 'getxattr', raising = False)
+        monkeypatch.delattr(os, 'setxattr', raising = False)
+    v = Vlermv(tempfile.mkdtemp(), serializer = identity_bytes, skip_unchanged = True)
+    v['a'] = b'abc'
+    inode = os.stat(v.filename('a')).st_ino
+    hashed_files = []
+    file_digest = _fs._file_digest
+    monkeypatch.setattr(_fs, '_file_digest', lambda fn: hashed_files.append(fn) or file_digest(fn))
+    v['a'] = b'abc'
+    assert os.stat(v.filename('a')).st_ino == inode
+    # Only the new value is hashed.
+    assert len(hashed_files) == 1
+    v['a'] = b'abd'
+    assert os.stat(v.filename('a')).st_ino != inode
+    assert v['a'] == b'abd'
+    assert os.listdir(v.tempdir) == []
+    assert list(v.keys()) == [('a',)]
+    assert os.path.exists(os.path.join(v.base_directory, '.vlermv-digests', 'a')) != xattr
+
+    # Edited in place, with the same size, so the stored digest is stale
+    fn = v.filename('a')
+    mtime = os.stat(fn).st_mtime_ns
+    with open(fn, 'r+b') as fp:
+        fp.write(b'xyz')
+    os.utime(fn, ns = (mtime + 10**9, mtime + 10**9))
+    v['a'] = b'abd'
+    assert v['a'] == b'abd'
+
+    del(v['a'])
+    assert not os.path.exists(os.path.join(v.base_directory, '.vlermv-digests', 'a'))
+
+def test_clear_relative(monkeypatch, tmpdir):
+    monkeypatch.chdir(tmpdir)
+    v = Vlermv('relative')
+    v['a'] = 1
+    thread = v.clear()
+    assert len(v) == 0
+    thread.join()
+    assert not any(fn.startswith('.relative.deleting-') for fn in os.listdir(str(tmpdir)))
+
+def test_clear_mount_point(monkeypatch, tmpdir):
+    v = Vlermv(str(tmpdir.join('mount')), key_transformer = hashed())
+    for i in range(10):
+        v[i] = i
+    rename = os.rename
+    def busy(src, dst):
+        if os.path.abspath(src) == os.path.abspath(v.base_directory):
+            raise OSError(errno.EBUSY, 'Device or resource busy')
+        rename(src, dst)
+    monkeypatch.setattr(os, 'rename', busy)
+    thread = v.clear()
+    assert len(v) == 0
+    assert os.listdir(v.base_directory) == ['.tmp']
+    v[1] = 'new'
+    assert list(v.values()) == ['new']
+
+    thread.join()
+    assert os.listdir(v.tempdir) == []
+
+def test_hashed_keys_round_trip():
+    v = Vlermv(tempfile.mkdtemp(), key_transformer = hashed())
+    v[('a', 1)] = 'a'
+    v[('b', 2)] = 'b'
+    assert sorted(v.values()) == ['a', 'b']
+    assert sorted(value for _, value in v.items()) == ['a', 'b']
+    for key in list(v.keys()):
+        del(v[key])
+    assert len(v) == 0
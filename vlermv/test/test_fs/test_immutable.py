@@ -33,6 +33,14 @@ class TestImmutableVlermv(Base):
         with pytest.raises(PermissionError):
             del(self.immutable[('a',)])
 
+    def test_delete_many(self):
+        self.mutable[('a',)] = 3
+        with pytest.raises(PermissionError):
+            self.immutable.delete_many([('a',)])
+        with pytest.raises(PermissionError):
+            self.immutable.clear()
+        assert self.mutable[('a',)] == 3
+
     def test_kwarg(self):
         assert (self.default.mutable)
         assert (self.mutable.mutable)
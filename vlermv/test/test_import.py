@@ -0,0 +1,50 @@
+import os, subprocess, sys
+
+import pytest
+
+#: Maximum seconds that "import vlermv" may take
+IMPORT_BUDGET = 0.25
+
+CODE = '''
+import sys, time
+start = time.perf_counter()
+import vlermv
+sys.stdout.write('%f\\n' % (time.perf_counter() - start))
+sys.stdout.write(' '.join(sorted(m for m in ('boto', 'lxml') if m in sys.modules)))
+'''
+
+def _import():
+    root = os.path.join(os.path.dirname(__file__), '..', '..')
+    output = subprocess.check_output([sys.executable, '-c', CODE], cwd = root)
+    seconds, modules = output.decode('ascii').split('\n')
+    return float(seconds), modules.split()
+
+def test_optional_modules_not_imported():
+    _, modules = _import()
+    assert modules == []
+
+def test_import_budget():
+    seconds = min(_import()[0] for _ in range(3))
+    assert seconds < IMPORT_BUDGET
+
+def test_lazy_attributes():
+    import vlermv
+    from vlermv import S3Vlermv
+    assert vlermv.S3Vlermv is S3Vlermv
+    from vlermv import AsyncS3Vlermv
+    assert vlermv.AsyncS3Vlermv is AsyncS3Vlermv
+    with pytest.raises(AttributeError):
+        vlermv.NotABackend
+    with pytest.raises(AttributeError):
+        vlermv.serializers.not_a_serializer
+
+def test_missing_optional_serializer(monkeypatch):
+    from vlermv import serializers
+    monkeypatch.setitem(sys.modules, 'lxml', None)
+    monkeypatch.delitem(sys.modules, 'vlermv.serializers._lxml', raising = False)
+    monkeypatch.delattr(serializers, '_lxml', raising = False)
+    monkeypatch.delattr(serializers, 'html', raising = False)
+    assert not hasattr(serializers, 'html')
+    assert getattr(serializers, 'html', None) == None
+    with pytest.raises(AttributeError):
+        serializers.html
@@ -0,0 +1,122 @@
+import os, socket, threading, time
+
+import pytest
+
+from .. import _retry
+from .._retry import retry, hedge
+
+class Flaky:
+    def __init__(self, failures, error = socket.timeout):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error('flaky')
+        return 'ok'
+
+def transient(error):
+    return isinstance(error, socket.timeout)
+
+def test_retry():
+    delays = []
+    f = Flaky(2)
+    assert retry(f, retries = 2, backoff = 1, retryable = transient, sleep = delays.append) == 'ok'
+    assert f.calls == 3
+    assert len(delays) == 2
+    assert 0 <= delays[0] <= 1
+    assert 0 <= delays[1] <= 2
+
+def test_retry_gives_up():
+    f = Flaky(3)
+    with pytest.raises(socket.timeout):
+        retry(f, retries = 2, retryable = transient, sleep = lambda _: None)
+    assert f.calls == 3
+
+def test_retry_not_retryable():
+    f = Flaky(1, ValueError)
+    with pytest.raises(ValueError):
+        retry(f, retries = 2, retryable = transient, sleep = lambda _: None)
+    assert f.calls == 1
+
+def test_max_backoff():
+    delays = []
+    retry(Flaky(5), retries = 5, backoff = 1, max_backoff = 3,
+          retryable = transient, sleep = delays.append)
+    assert max(delays) <= 3
+
+def test_deadline():
+    release = threading.Event()
+    start = time.monotonic()
+    with pytest.raises(socket.timeout):
+        retry(release.wait, deadline = 0.05)
+    assert time.monotonic() - start < 1
+    release.set()
+
+def test_deadline_stops_retries():
+    f = Flaky(100)
+    with pytest.raises(socket.timeout):
+        retry(f, retries = 100, backoff = 0.02, deadline = 0.05, retryable = transient)
+    assert f.calls < 100
+
+def test_hedge():
+    calls = []
+    release = threading.Event()
+    def f():
+        calls.append(None)
+        if len(calls) == 1:
+            release.wait(5) # The first call is slow.
+            return 'slow'
+        return 'fast'
+    assert hedge(f, hedge_after = 0.01) == 'fast'
+    assert len(calls) == 2
+    release.set()
+
+def test_hedge_not_needed():
+    f = Flaky(0)
+    assert hedge(f, hedge_after = 1) == 'ok'
+    assert f.calls == 1
+
+def test_hedge_error():
+    f = Flaky(1, ValueError)
+    with pytest.raises(ValueError):
+        hedge(f, hedge_after = 1)
+    assert f.calls == 1
+
+def test_hedge_discard():
+    calls = []
+    release = threading.Event()
+    discarded = threading.Event()
+    def f():
+        calls.append(None)
+        if len(calls) == 1:
+            release.wait(5)
+            return 'slow'
+        return 'fast'
+    def discard(result):
+        assert result == 'slow'
+        discarded.set()
+    assert hedge(f, hedge_after = 0.01, discard = discard) == 'fast'
+    assert not discarded.is_set()
+    release.set()
+    assert discarded.wait(5)
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason = 'needs fork')
+def test_after_fork():
+    # Leaves an idle worker thread, which the child doesn't inherit
+    assert retry(lambda: 1, deadline = 1) == 1
+    for _ in range(100):
+        if _retry._workers._idle > 0:
+            break
+        time.sleep(0.01)
+    pid = os.fork()
+    if pid == 0:
+        # Exit whatever happens, so that the child never runs the rest of pytest.
+        status = 1
+        try:
+            status = 0 if retry(lambda: 2, deadline = 1) == 2 else 1
+        finally:
+            os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
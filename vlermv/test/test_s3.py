@@ -1,35 +1,120 @@
-import json, socket
+import json, zlib, socket, io, tempfile, threading, time, email.utils, hashlib
 
 import pytest
+from boto.exception import S3ResponseError
 
-from .._s3 import S3Vlermv
+from .._s3 import S3Vlermv, _transient
+from ..serializers import identity_bytes
 
 class FakeBucket:
     def __init__(self, name, raise_timeout = False, **db):
         self.db = db
         self.name = name
         self.raise_timeout = raise_timeout
+        self.requests = []
+        self.ranges = []
+        self.modified = {}
+        self.uploads = []
     def list(self, prefix = ''):
         for key in self.db:
             if key.startswith(prefix):
-                yield self.new_key(key)
+                fakekey = self.new_key(key)
+                fakekey.size = len(self.db[key])
+                yield fakekey
     def new_key(self, key):
         return FakeKey(self, key)
     def get_key(self, key):
+        self.requests.append(('HEAD', key))
         if key in self.db:
-            return FakeKey(self, key)
+            fakekey = FakeKey(self, key)
+            fakekey.last_modified = fakekey._last_modified()
+            fakekey.etag = fakekey._etag()
+            return fakekey
     def delete_key(self, key):
-        del(self.db[key])
+        # S3 doesn't mind deleting keys that don't exist.
+        self.db.pop(key, None)
+    def delete_keys(self, keys, quiet = False):
+        self.requests.append(('DELETE', len(keys)))
+        for key in keys:
+            self.db.pop(key, None)
+        return FakeMultiDeleteResult()
+    def initiate_multipart_upload(self, key):
+        self.requests.append(('MULTIPART', key))
+        self.uploads.append(FakeMultiPartUpload(self, key))
+        return self.uploads[-1]
+
+class FakeMultiDeleteResult:
+    errors = []
+
+class FakeMultiPartUpload:
+    def __init__(self, bucket, key_name):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.parts = {}
+    def upload_part_from_file(self, fp, part_num, **kwargs):
+        self.parts[part_num] = fp.read()
+    def complete_upload(self):
+        self.bucket.db[self.key_name] = b''.join(v for _, v in sorted(self.parts.items()))
+    def cancel_upload(self):
+        self.parts = {}
 
 class FakeKey:
     def __init__(self, bucket, name):
         self.bucket = bucket
         self.name = name
-    def get_contents_as_string(self):
+        self.position = 0
+        self.last_modified = None
+    def _last_modified(self):
+        return email.utils.formatdate(self.bucket.modified.get(self.name, 0), usegmt = True)
+    def _etag(self):
+        return '"%s"' % hashlib.md5(self.bucket.db[self.name]).hexdigest()
+    def _get(self, headers = None):
+        self.bucket.requests.append(('GET', self.name))
+        headers = headers or {}
         if self.bucket.raise_timeout:
             raise socket.timeout('The read operation timed out')
-        else:
-            return self.bucket.db[self.name]
+        elif self.name not in self.bucket.db:
+            raise S3ResponseError(404, 'Not Found')
+        data = self.bucket.db[self.name]
+        self.last_modified = self._last_modified()
+        self.size = len(data)
+        self.etag = self._etag()
+        if 'If-Match' in headers and headers['If-Match'] != self.etag:
+            raise S3ResponseError(412, 'Precondition Failed')
+        if headers.get('If-None-Match') == self.etag:
+            raise S3ResponseError(304, 'Not Modified')
+        if 'Range' in headers:
+            start, end = headers['Range'][len('bytes='):].split('-')
+            start, end = int(start), int(end or len(data))
+            if start >= len(data):
+                raise S3ResponseError(416, 'Requested Range Not Satisfiable')
+            self.bucket.ranges.append(start)
+            return data[start:end + 1]
+        return data
+    def open_read(self):
+        if getattr(self, 'resp', None) == None:
+            self._get()
+            self.resp = True
+    def read(self, size = 0):
+        # Like boto, this closes the key at the end, so the next read
+        # starts again from the beginning.
+        self.open_read()
+        if self.bucket.raise_timeout:
+            raise socket.timeout('The read operation timed out')
+        data = self.bucket.db[self.name]
+        end = len(data) if size == 0 else self.position + size
+        chunk = data[self.position:end]
+        self.position += len(chunk)
+        if not chunk:
+            self.close()
+        return chunk
+    def close(self, fast = False):
+        self.position = 0
+        self.resp = None
+    def get_contents_as_string(self, headers = None):
+        return self._get(headers)
+    def get_contents_to_file(self, fp, headers = None):
+        fp.write(self._get(headers))
     def get_contents_to_filename(self, filename):
         if self.bucket.raise_timeout:
             raise socket.timeout('The read operation timed out')
@@ -37,7 +122,12 @@ class FakeKey:
             with open(filename, 'wb') as fp:
                 fp.write(self.bucket.db[self.name])
     def set_contents_from_string(self, payload, **kwargs):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
         self.bucket.db[self.name] = payload
+    def set_contents_from_file(self, fp, **kwargs):
+        self.bucket.db[self.name] = fp.read()
+        assert isinstance(self.bucket.db[self.name], bytes)
     def set_contents_from_filename(self, filename, **kwargs):
         with open(filename, 'rb') as fp:
             self.bucket.db[self.name] = fp.read()
@@ -56,6 +146,65 @@ def test_read():
                  bucket = FakeBucket('aoeu', OP00032101 = PAYLOAD))
     assert d['OP00032101'] == CONTRACT
 
+@pytest.mark.parametrize('size', [0, 1, 20, 21, 22, 100])
+def test_ranged_download(size):
+    data = bytes(range(size))
+    fakebucket = FakeBucket('aoeu', big = data)
+    d = S3Vlermv('contracts', bucket = fakebucket, serializer = identity_bytes,
+                 multipart_threshold = 21, part_size = 7)
+    assert d['big'] == data
+    expected = list(range(0, size, 21))[:1] + list(range(21, size, 7))
+    assert sorted(fakebucket.ranges) == expected
+
+def test_ranged_download_changed():
+    fakebucket = FakeBucket('aoeu', big = bytes(30))
+    d = S3Vlermv('contracts', bucket = fakebucket, serializer = identity_bytes,
+                 multipart_threshold = 10, part_size = 10)
+    class ChangingKey(FakeKey):
+        def _get(self, headers = None):
+            if headers and 'If-Match' in headers:
+                self.bucket.db['big'] = bytes(31)
+            return super(ChangingKey, self)._get(headers)
+    fakebucket.new_key = lambda name: ChangingKey(fakebucket, name)
+    with pytest.raises(S3ResponseError):
+        d['big']
+
+@pytest.mark.parametrize('size', [0, 10, 21, 50])
+def test_multipart_upload(size):
+    data = bytes(range(size))
+    fakebucket = FakeBucket('aoeu')
+    d = S3Vlermv('contracts', bucket = fakebucket, serializer = identity_bytes,
+                 multipart_threshold = 20, part_size = 7, transfer_workers = 3)
+    d['big'] = data
+    d.put_stream('stream', io.BytesIO(data))
+    assert fakebucket.db == {'big': data, 'stream': data}
+    multipart = ('MULTIPART', 'big') in fakebucket.requests
+    assert multipart == (size > 20)
+
+def test_read_missing():
+    fakebucket = FakeBucket('aoeu')
+    d = S3Vlermv('contracts', serializer = json, bucket = fakebucket)
+    with pytest.raises(KeyError):
+        d['OP00032101']
+    assert d.get('OP00032101', 'default') == 'default'
+    assert fakebucket.requests == [('GET', 'OP00032101')] * 2
+
+def test_read_one_request():
+    fakebucket = FakeBucket('aoeu', OP00032101 = PAYLOAD)
+    d = S3Vlermv('contracts', serializer = json, bucket = fakebucket)
+    d['OP00032101']
+    assert fakebucket.requests == [('GET', 'OP00032101')]
+
+def test_memoize_hit_one_request():
+    fakebucket = FakeBucket('aoeu')
+    @S3Vlermv.memoize('contracts', serializer = json, bucket = fakebucket)
+    def f(x):
+        return x * 2
+    assert f(21) == 42
+    fakebucket.requests = []
+    assert f(21) == 42
+    assert fakebucket.requests == [('GET', '21')]
+
 def test_write():
     fakebucket = FakeBucket('aoeu')
     d = S3Vlermv('contracts', bucket = fakebucket, serializer = json)
@@ -63,6 +212,38 @@ def test_write():
     d['OP00032101'] = CONTRACT
     assert fakebucket.db == {'OP00032101': PAYLOAD}
 
+class spy_tempfile:
+    def __init__(self, monkeypatch):
+        self.spooled = []
+        self.named = 0
+        monkeypatch.setattr(tempfile, 'NamedTemporaryFile', self.named_temporary_file)
+        original = tempfile.SpooledTemporaryFile
+        def spooled_temporary_file(*args, **kwargs):
+            fp = original(*args, **kwargs)
+            self.spooled.append(fp)
+            return fp
+        monkeypatch.setattr(tempfile, 'SpooledTemporaryFile', spooled_temporary_file)
+    def named_temporary_file(self, *args, **kwargs):
+        self.named += 1
+        raise AssertionError('Values should not go through named temporary files.')
+
+@pytest.mark.parametrize('spool_size, rolled', [(8 * 2**20, False), (10, True)])
+def test_spool(monkeypatch, spool_size, rolled):
+    spy = spy_tempfile(monkeypatch)
+    fakebucket = FakeBucket('aoeu')
+    d = S3Vlermv('contracts', bucket = fakebucket, serializer = json,
+                 spool_size = spool_size)
+    d['OP00032101'] = CONTRACT
+    assert d['OP00032101'] == CONTRACT
+    assert fakebucket.db == {'OP00032101': PAYLOAD}
+    assert [fp._rolled for fp in spy.spooled] == [rolled, rolled]
+    assert spy.named == 0
+
+def test_binary_round_trip():
+    d = S3Vlermv('contracts', bucket = FakeBucket('aoeu'))
+    d['OP00032101'] = CONTRACT
+    assert d['OP00032101'] == CONTRACT
+
 def test_delete():
     fakebucket = FakeBucket('aoeu')
     d = S3Vlermv('contracts', bucket = fakebucket, serializer = json)
@@ -91,6 +272,64 @@ def test_handle_socket_timeout():
     with pytest.raises(d.Timeout):
         d[9]
 
+def test_open_read():
+    d = S3Vlermv('contracts', serializer = json,
+                 bucket = FakeBucket('aoeu', OP00032101 = PAYLOAD))
+    with d.open_read('OP00032101') as fp:
+        assert fp.read(5) == PAYLOAD[:5]
+        assert fp.read() == PAYLOAD[5:]
+    with pytest.raises(KeyError):
+        d.open_read('not-a-contract')
+
+def test_open_read_chunks():
+    fakebucket = FakeBucket('aoeu', a = bytes(range(100)))
+    d = S3Vlermv('contracts', bucket = fakebucket)
+    with d.open_read('a') as fp:
+        chunks = list(iter(lambda: fp.read(7), b''))
+        assert fp.read(7) == b''
+    assert b''.join(chunks) == bytes(range(100))
+    assert fakebucket.requests == [('GET', 'a')]
+
+class Unseekable(io.RawIOBase):
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+    def readable(self):
+        return True
+    def readinto(self, b):
+        return self.data.readinto(b)
+
+class ShortReads(Unseekable):
+    'Like a pipe, which may return fewer bytes than were asked for'
+    def readinto(self, b):
+        return self.data.readinto(memoryview(b)[:2])
+
+@pytest.mark.parametrize('size', [0, 5, 10, 23])
+def test_put_stream_short_reads(size):
+    fakebucket = FakeBucket('aoeu')
+    d = S3Vlermv('contracts', bucket = fakebucket, part_size = 5)
+    data = bytes(range(size))
+    d.put_stream('pipe', ShortReads(data))
+    assert fakebucket.db == {'pipe': data}
+    for upload in fakebucket.uploads:
+        sizes = [len(part) for _, part in sorted(upload.parts.items())]
+        assert all(n == 5 for n in sizes[:-1])
+
+@pytest.mark.parametrize('size', [0, 5, 10, 23])
+def test_put_stream(size):
+    fakebucket = FakeBucket('aoeu')
+    d = S3Vlermv('contracts', bucket = fakebucket, part_size = 5)
+    data = bytes(range(size))
+    d.put_stream('seekable', io.BytesIO(data))
+    d.put_stream('unseekable', Unseekable(data))
+    assert fakebucket.db == {'seekable': data, 'unseekable': data}
+
+def test_put_stream_immutable():
+    fakebucket = FakeBucket('aoeu', a = b'abc')
+    d = S3Vlermv('contracts', bucket = fakebucket, mutable = False)
+    with pytest.raises(PermissionError):
+        d.put_stream('a', io.BytesIO(b'def'))
+    assert fakebucket.db == {'a': b'abc'}
+
 tc = [
     ('get_contents_to_filename', ('/not/a/file',)),
     ('get_contents_as_string', tuple()),
@@ -106,3 +345,463 @@ def test_fake_key_timeout(method, args):
         assert t.args == ('The read operation timed out',)
     else:
         raise AssertionError('FakeBucket did not raise timeout.')
+
+def test_connection_per_thread():
+    import threading
+    from .._safe_buckets import SafeBuckets
+
+    db = {}
+    connections = []
+    class FakeConnection:
+        def __init__(self):
+            connections.append(self)
+        def create_bucket(self, name):
+            return FakeBucket(name)
+        def get_bucket(self, name, validate = True):
+            assert not validate
+            bucket = FakeBucket(name)
+            bucket.db = db
+            bucket.connection = self
+            return bucket
+
+    class ThreadedS3Vlermv(S3Vlermv):
+        buckets = SafeBuckets(connect = FakeConnection)
+
+    d = ThreadedS3Vlermv('contracts', serializer = json)
+    seen = []
+    def work(i):
+        d[str(i)] = i
+        assert d[str(i)] == i
+        seen.append((threading.get_ident(), d.bucket.connection))
+
+    threads = [threading.Thread(target = work, args = (i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(db) == 8
+    assert len(set(connection for _, connection in seen)) == 8
+    assert d.bucket is d.bucket
+    assert repr(d) == 'S3Vlermv(contracts/)'
+
+def test_transfer_connections_reused():
+    from .._safe_buckets import SafeBuckets
+
+    db = {str(i): bytes(range(100)) for i in range(5)}
+    connections = []
+    class FakeConnection:
+        def __init__(self):
+            connections.append(self)
+        def create_bucket(self, name):
+            return FakeBucket(name)
+        def get_bucket(self, name, validate = True):
+            bucket = FakeBucket(name)
+            bucket.db = db
+            return bucket
+
+    class ThreadedS3Vlermv(S3Vlermv):
+        buckets = SafeBuckets(connect = FakeConnection)
+
+    d = ThreadedS3Vlermv('contracts', serializer = identity_bytes,
+                         multipart_threshold = 10, part_size = 10, transfer_workers = 2)
+    for i in range(5):
+        assert d[str(i)] == bytes(range(100))
+    # The calling thread's and the two transfer threads'
+    assert len(connections) == 3
+    d.close()
+    assert d._transfers == None
+
+def test_manifest():
+    fakebucket = FakeBucket('aoeu', **{'contracts/a': b'1', 'contracts/b': b'2', 'other/c': b'3'})
+    d = S3Vlermv('procurement', 'contracts', bucket = fakebucket,
+                 serializer = identity_bytes, manifest = True)
+
+    # Made from a listing the first time
+    assert set(d.keys()) == {('a',), ('b',)}
+    assert 'contracts/.vlermv-manifest' in fakebucket.db
+
+    fakebucket.requests = []
+    assert len(d) == 2
+    assert fakebucket.requests == [('GET', 'contracts/.vlermv-manifest')]
+
+    d['c'] = b'3'
+    del(d['a'])
+    assert set(d.keys()) == {('b',), ('c',)}
+
+    # Written by something else
+    fakebucket.db['contracts/d'] = b'4'
+    assert len(d) == 2
+    assert d.resync() == ['contracts/b', 'contracts/c', 'contracts/d']
+    assert len(d) == 3
+
+def test_manifest_interleaved_writers(monkeypatch):
+    fakebucket = FakeBucket('aoeu')
+    a, b = (S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes, manifest = True)
+            for _ in range(2))
+    assert len(a) == 0
+
+    # b writes while a is updating the manifest.
+    interleaved = []
+    set_contents_from_string = FakeKey.set_contents_from_string
+    def interleave(key, payload, **kwargs):
+        if key.name.startswith('x/.vlermv-manifest') and not interleaved:
+            interleaved.append(key.name)
+            b['2'] = b''
+        set_contents_from_string(key, payload, **kwargs)
+    monkeypatch.setattr(FakeKey, 'set_contents_from_string', interleave)
+    fakebucket.requests = []
+    a['1'] = b''
+    assert ('GET', 'x/.vlermv-manifest') not in fakebucket.requests
+    assert sorted(a.keys()) == sorted(b.keys()) == [('1',), ('2',)]
+
+def test_manifest_compaction():
+    fakebucket = FakeBucket('aoeu')
+    d = S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes,
+                 manifest = True, manifest_grace = 0)
+    for i in range(3):
+        d[str(i)] = b''
+    del(d['1'])
+    updates = [k for k in fakebucket.db if k.startswith('x/.vlermv-manifest.d/')]
+    assert len(updates) == 4
+
+    # Compacted on the first read and deleted on the next
+    assert sorted(d.keys()) == [('0',), ('2',)]
+    time.sleep(0.01)
+    assert sorted(d.keys()) == [('0',), ('2',)]
+    assert not any(k.startswith('x/.vlermv-manifest.d/') for k in fakebucket.db)
+    assert sorted(d.keys()) == [('0',), ('2',)]
+
+def test_manifest_partial_compaction():
+    fakebucket = FakeBucket('aoeu')
+    d = S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes, manifest = True)
+    d.resync()
+    d['a'] = b''
+    d['b'] = b''
+    # The update for a is old enough to compact, and the one for b isn't.
+    first = min(k for k in fakebucket.db if k.startswith('x/.vlermv-manifest.d/'))
+    old = 'x/.vlermv-manifest.d/%020d-%s' % (1, first.split('-')[-1])
+    fakebucket.db[old] = fakebucket.db.pop(first)
+
+    assert sorted(d.keys()) == [('a',), ('b',)]
+    manifest = json.loads(zlib.decompress(fakebucket.db['x/.vlermv-manifest']).decode('utf-8'))
+    assert manifest['keynames'] == ['x/a']
+    assert manifest['through'] == old
+    assert sorted(d.keys()) == [('a',), ('b',)]
+
+def test_manifest_read_only():
+    fakebucket = FakeBucket('aoeu', **{'x/a': b''})
+    reader = S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes,
+                      manifest = True, manifest_grace = 0, mutable = False, appendable = False)
+    # No manifest yet, so it lists the prefix without writing one.
+    assert list(reader.keys()) == [('a',)]
+    assert set(fakebucket.db) == {'x/a'}
+
+    writer = S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes,
+                      manifest = True, manifest_grace = 0)
+    writer.resync()
+    writer['b'] = b''
+    time.sleep(0.01)
+    before = dict(fakebucket.db)
+    fakebucket.requests = []
+    assert sorted(reader.keys()) == [('a',), ('b',)]
+    assert fakebucket.db == before
+    assert ('DELETE', 1) not in fakebucket.requests
+
+def test_manifest_other_objects():
+    fakebucket = FakeBucket('aoeu', **{'x/.vlermv-manifest.d/notes.txt': b'hello'})
+    d = S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes,
+                 manifest = True, manifest_grace = 0)
+    d['a'] = b''
+    time.sleep(0.01)
+    assert list(d.keys()) == [('a',)]
+    assert list(d.keys()) == [('a',)]
+    assert 'x/.vlermv-manifest.d/notes.txt' in fakebucket.db
+
+def test_no_manifest():
+    fakebucket = FakeBucket('aoeu', a = b'1')
+    d = S3Vlermv('procurement', bucket = fakebucket, serializer = identity_bytes)
+    d['b'] = b'2'
+    assert set(d.keys()) == {('a',), ('b',)}
+    assert set(fakebucket.db) == {'a', 'b'}
+
+def test_local_cache(tmpdir):
+    fakebucket = FakeBucket('aoeu', **{'contracts/OP00032101': PAYLOAD})
+    d = S3Vlermv('procurement', 'contracts', bucket = fakebucket,
+                 serializer = json, local_cache = str(tmpdir))
+
+    assert d['OP00032101'] == CONTRACT
+    with open(str(tmpdir.join('procurement', 'contracts', 'OP00032101')), 'rb') as fp:
+        etag, payload = fp.read().split(b'\n', 1)
+    assert payload == PAYLOAD
+
+    # Not modified
+    fakebucket.requests = []
+    assert d['OP00032101'] == CONTRACT
+    assert fakebucket.requests == [('GET', 'contracts/OP00032101')]
+
+    # Modified by something else
+    fakebucket.db['contracts/OP00032101'] = b'"changed"'
+    assert d['OP00032101'] == 'changed'
+    assert d['OP00032101'] == 'changed'
+
+    # Deleted by something else
+    del(fakebucket.db['contracts/OP00032101'])
+    with pytest.raises(KeyError):
+        d['OP00032101']
+    assert not tmpdir.join('procurement', 'contracts', 'OP00032101').check()
+
+def test_local_cache_buckets(tmpdir):
+    one = S3Vlermv('one', bucket = FakeBucket('one', a = b'"from bucket one"'), serializer = json,
+                   local_cache = str(tmpdir), freshness = 60)
+    two = S3Vlermv('two', bucket = FakeBucket('two', a = b'"from bucket two"'), serializer = json,
+                   local_cache = str(tmpdir), freshness = 60)
+    assert one['a'] == 'from bucket one'
+    assert two['a'] == 'from bucket two'
+    assert one['a'] == 'from bucket one'
+
+def test_local_cache_304(tmpdir, monkeypatch):
+    fakebucket = FakeBucket('aoeu', a = PAYLOAD)
+    d = S3Vlermv('procurement', bucket = fakebucket,
+                 serializer = json, local_cache = str(tmpdir))
+    d['a']
+    responses = []
+    original = FakeKey._get
+    def _get(key, headers = None):
+        try:
+            return original(key, headers)
+        except S3ResponseError as e:
+            responses.append(e.status)
+            raise
+    monkeypatch.setattr(FakeKey, '_get', _get)
+    assert d['a'] == CONTRACT
+    assert responses == [304]
+
+def test_local_cache_freshness(tmpdir):
+    fakebucket = FakeBucket('aoeu', a = PAYLOAD)
+    d = S3Vlermv('procurement', bucket = fakebucket, serializer = json,
+                 local_cache = str(tmpdir), freshness = 60)
+    assert d['a'] == CONTRACT
+    fakebucket.requests = []
+    assert d['a'] == CONTRACT
+    assert fakebucket.requests == []
+
+    # Writes through this S3Vlermv invalidate the cache.
+    d['a'] = 'new'
+    assert d['a'] == 'new'
+
+@pytest.mark.parametrize('offset, length, expected', [
+    (0, 3, b'abc'), (2, None, b'cdefghij'), (8, 5, b'ij'), (10, 3, b''), (20, None, b''), (3, 0, b''),
+])
+def test_get_range(offset, length, expected):
+    d = S3Vlermv('x', bucket = FakeBucket('aoeu', a = b'abcdefghij'), serializer = identity_bytes)
+    assert d.get_range('a', offset, length) == expected
+
+def test_get_range_missing():
+    d = S3Vlermv('x', bucket = FakeBucket('aoeu'), serializer = identity_bytes)
+    with pytest.raises(KeyError):
+        d.get_range('a', 0, 3)
+
+class FlakyBucket(FakeBucket):
+    'Time out on the first few GETs'
+    def __init__(self, name, failures, **db):
+        super(FlakyBucket, self).__init__(name, **db)
+        self.failures = failures
+    @property
+    def raise_timeout(self):
+        return len(self.requests) <= self.failures
+    @raise_timeout.setter
+    def raise_timeout(self, value):
+        pass
+
+def test_retry():
+    fakebucket = FlakyBucket('aoeu', 2, OP00032101 = PAYLOAD)
+    d = S3Vlermv('contracts', bucket = fakebucket, serializer = json, retries = 2, backoff = 0)
+    assert d['OP00032101'] == CONTRACT
+    assert len(fakebucket.requests) == 3
+
+def test_retry_gives_up():
+    fakebucket = FlakyBucket('aoeu', 3, OP00032101 = PAYLOAD)
+    d = S3Vlermv('contracts', bucket = fakebucket, serializer = json, retries = 2, backoff = 0)
+    with pytest.raises(d.Timeout):
+        d['OP00032101']
+
+def test_no_retry_missing():
+    fakebucket = FakeBucket('aoeu')
+    d = S3Vlermv('contracts', bucket = fakebucket, serializer = json, retries = 2)
+    with pytest.raises(KeyError):
+        d['OP00032101']
+    assert len(fakebucket.requests) == 1
+
+class SlowBucket(FakeBucket):
+    'The first GET hangs.'
+    def __init__(self, name, **db):
+        super(SlowBucket, self).__init__(name, **db)
+        self.release = threading.Event()
+    def new_key(self, key):
+        bucket = self
+        class SlowKey(FakeKey):
+            def _get(self, headers = None):
+                first = bucket.requests == []
+                data = super(SlowKey, self)._get(headers)
+                if first:
+                    bucket.release.wait(5)
+                return data
+        return SlowKey(self, key)
+
+def test_hedged_get():
+    fakebucket = SlowBucket('aoeu', OP00032101 = PAYLOAD)
+    d = S3Vlermv('contracts', bucket = fakebucket, serializer = json, hedge_after = 0.01)
+    assert d['OP00032101'] == CONTRACT
+    assert len(fakebucket.requests) == 2
+    fakebucket.release.set()
+
+def test_hedged_manifest_keys(monkeypatch):
+    fakebucket = SlowBucket('aoeu', **{'x/a': b''})
+    d = S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes,
+                 manifest = True, hedge_after = 0.01)
+    d.resync()
+    keys = []
+    get = FakeKey._get
+    def record(key, headers = None):
+        keys.append(key)
+        return get(key, headers)
+    monkeypatch.setattr(FakeKey, '_get', record)
+    assert list(d.keys()) == [('a',)]
+    fakebucket.release.set()
+    # Each hedged request has its own key.
+    assert len(keys) == 2
+    assert keys[0] is not keys[1]
+
+def test_deadline():
+    fakebucket = SlowBucket('aoeu', OP00032101 = PAYLOAD)
+    d = S3Vlermv('contracts', bucket = fakebucket, serializer = json, deadline = 0.05)
+    with pytest.raises(d.Timeout):
+        d['OP00032101']
+    fakebucket.release.set()
+
+def test_delete_many():
+    fakebucket = FakeBucket('aoeu', **{'x/%d' % i: b'' for i in range(2500)})
+    d = S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes)
+    d.delete_many(str(i) for i in range(2400))
+    # Each key goes with its cost record.
+    assert fakebucket.requests == [('DELETE', 1000)] * 4 + [('DELETE', 800)]
+    assert len(d) == 100
+
+def test_delete_many_manifest():
+    fakebucket = FakeBucket('aoeu')
+    d = S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes, manifest = True)
+    for i in range(5):
+        d[str(i)] = b''
+    del(fakebucket.requests[:])
+    d.delete_many(['1', '2', '3'])
+    assert sorted(d.keys()) == [('0',), ('4',)]
+    assert ('DELETE', 6) in fakebucket.requests
+
+def test_clear():
+    fakebucket = FakeBucket('aoeu', **{'x/a': b'', 'x/b': b'', 'y/c': b''})
+    d = S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes, manifest = True)
+    assert len(d) == 2
+    d.clear()
+    assert list(fakebucket.db) == ['y/c']
+    assert len(d) == 0
+
+def test_bloom_filter(tmpdir):
+    fakebucket = FakeBucket('aoeu', **{'x/a': b'1'})
+    d = S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes,
+                 bloom_filter = str(tmpdir.join('bloom')))
+    d['b'] = b'2'
+    del(fakebucket.requests[:])
+    assert d.get('b') == b'2'
+    assert 'c' not in d
+    assert d.get('c') == None
+    assert fakebucket.requests == [('GET', 'x/b')]
+
+    assert 'a' not in d
+    d.rebuild_bloom_filter()
+    assert 'a' in d
+
+def test_ttl():
+    fakebucket = FakeBucket('aoeu')
+    calls = []
+    @S3Vlermv.memoize('aoeu', bucket = fakebucket, serializer = json, ttl = 60)
+    def f(x):
+        calls.append(x)
+        return len(calls)
+    assert f('a') == 1
+    fakebucket.modified['a'] = time.time()
+    assert f('a') == 1
+    fakebucket.modified['a'] = time.time() - 120
+    assert f('a') == 2
+
+def test_ttl_local_cache(tmpdir):
+    fakebucket = FakeBucket('aoeu', a = b'1')
+    d = S3Vlermv('aoeu', bucket = fakebucket, serializer = json, ttl = 60,
+                 local_cache = str(tmpdir))
+    fakebucket.modified['a'] = time.time() - 30
+    value, mtime = d._lookup_dated('a')
+    assert value == 1
+    assert mtime == int(fakebucket.modified['a'])
+
+def test_evict():
+    fakebucket = FakeBucket('aoeu')
+    @S3Vlermv.memoize('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes,
+                      record_cost = True, manifest = True)
+    def f(x):
+        if x == 'slow':
+            time.sleep(0.05)
+        return b'.' * 10
+    f('slow')
+    f('fast')
+    assert sorted(f.keys()) == [('fast',), ('slow',)]
+    assert f.evict(15) == 1
+    assert sorted(f.keys()) == [('slow',)]
+    assert sorted(k for k in fakebucket.db if '.vlermv-manifest.d/' not in k) == \
+        ['x/.vlermv-costs/slow', 'x/.vlermv-inflation', 'x/.vlermv-manifest', 'x/slow']
+
+def test_delete_cost_records():
+    fakebucket = FakeBucket('aoeu')
+    f = S3Vlermv.memoize('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes,
+                         record_cost = True)(lambda x: b'.')
+    f('a')
+    f('b')
+    maintenance = S3Vlermv('aoeu', 'x', bucket = fakebucket, serializer = identity_bytes)
+    del(maintenance['a'])
+    maintenance.delete_many(['b'])
+    assert not any('.vlermv-costs/' in k for k in fakebucket.db)
+
+def test_skip_unchanged():
+    fakebucket = FakeBucket('aoeu')
+    d = S3Vlermv('aoeu', bucket = fakebucket, serializer = identity_bytes, skip_unchanged = True)
+    d['a'] = b'1'
+    d['a'] = b'1'
+    d['a'] = b'2'
+    assert fakebucket.db == {'a': b'2'}
+    assert fakebucket.requests == [('HEAD', 'a'), ('HEAD', 'a'), ('HEAD', 'a')]
+    assert d._etag(io.BytesIO(b'1')) == hashlib.md5(b'1').hexdigest()
+
+def test_skip_unchanged_ttl():
+    fakebucket = FakeBucket('aoeu')
+    d = S3Vlermv('aoeu', bucket = fakebucket, serializer = identity_bytes,
+                 skip_unchanged = True, ttl = 60)
+    d['a'] = b'1'
+    d['a'] = b'1'
+    # Identical values are written anyway, to refresh Last-Modified.
+    assert fakebucket.requests == []
+    assert fakebucket.db == {'a': b'1'}
+
+def test_multipart_etag():
+    d = S3Vlermv('aoeu', bucket = FakeBucket('aoeu'), multipart_threshold = 4, part_size = 4)
+    parts = hashlib.md5(b'abcd').digest() + hashlib.md5(b'ef').digest()
+    assert d._etag(io.BytesIO(b'abcdef')) == hashlib.md5(parts).hexdigest() + '-2'
+
+@pytest.mark.parametrize('error, transient', [
+    (socket.timeout('timed out'), True),
+    (ConnectionResetError(104, 'Connection reset by peer'), True),
+    (S3ResponseError(503, 'Slow Down'), True),
+    (S3ResponseError(404, 'Not Found'), False),
+    (OSError(28, 'No space left on device'), False),
+    (PermissionError(13, 'Permission denied'), False),
+])
+def test_transient(error, transient):
+    assert _transient(error) == transient
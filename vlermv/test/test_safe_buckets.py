@@ -1,5 +1,7 @@
+import gc, os, threading, time, weakref
 from functools import partial
 
+import pytest
 import thready
 
 from .._safe_buckets import SafeBuckets
@@ -33,3 +35,69 @@ def test_get_old():
     train = 'TRAAAAAAAAAAAIN'
     sb.state = {'abc': train}
     assert sb['abc'] == train
+
+def test_create_once_across_threads():
+    calls = []
+    def slow_create_bucket(bucketname):
+        calls.append(bucketname)
+        time.sleep(0.1)
+        return bucketname.upper()
+
+    sb = SafeBuckets(create_bucket = slow_create_bucket)
+    results = []
+    threads = [threading.Thread(target = lambda: results.append(sb['abc'])) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['ABC'] * 10
+    assert calls == ['abc']
+
+def test_no_wait_for_existing():
+    def create_bucket(bucketname):
+        raise AssertionError('This should not run.')
+    sb = SafeBuckets(create_bucket = create_bucket)
+    sb.state['abc'] = 'ABC'
+    sb._lock.acquire()
+    try:
+        assert sb['abc'] == 'ABC'
+    finally:
+        sb._lock.release()
+
+def test_failure_is_not_cached():
+    attempts = []
+    def flaky_create_bucket(bucketname):
+        attempts.append(bucketname)
+        if len(attempts) == 1:
+            raise EnvironmentError('Pretend that S3 is down.')
+        return bucketname
+    sb = SafeBuckets(create_bucket = flaky_create_bucket)
+    with pytest.raises(EnvironmentError):
+        sb['abc']
+    assert sb['abc'] == 'abc'
+    assert len(attempts) == 2
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason = 'Requires os.fork')
+def test_after_fork():
+    f = partial(create_bucket, Count())
+    sb = SafeBuckets(create_bucket = f)
+    assert sb['abc'] == ('abc', 1)
+    sb._lock.acquire() # As if another thread held it during the fork
+    pid = os.fork()
+    if pid == 0:
+        # Exit whatever happens, so that the child never runs the rest of pytest.
+        status = 1
+        try:
+            status = 0 if sb['abc'] == ('abc', 1) and sb['def'] == ('def', 2) else 1
+        finally:
+            os._exit(status)
+    sb._lock.release()
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+
+def test_not_kept_alive():
+    sb = SafeBuckets(create_bucket = partial(create_bucket, Count()))
+    ref = weakref.ref(sb)
+    del(sb)
+    gc.collect()
+    assert ref() == None
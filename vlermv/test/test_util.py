@@ -1,6 +1,8 @@
+import threading, time
+
 import pytest
 
-from .._util import split, method_or_name, safe_path
+from .._util import split, method_or_name, safe_path, read_ahead
 
 def test_split_empty():
     '''
@@ -56,3 +58,44 @@ def test_safe_path(unsafe_path, expected):
     else:
         with pytest.raises(ValueError):
             safe_path(unsafe_path)
+
+def test_safe_path_fast():
+    'Plain names go through unchanged.'
+    assert safe_path(('abc', 'def ghi', '\\..')) == ('abc', 'def ghi', '\\..')
+    assert safe_path(['abc']) == ('abc',)
+
+def test_read_ahead_ordered():
+    def f(x):
+        time.sleep(0.01 * (5 - x))
+        return x * 2
+    assert list(read_ahead(f, range(5), 3)) == [(x, x * 2) for x in range(5)]
+
+def test_read_ahead_unordered():
+    def f(x):
+        time.sleep(0.2 if x == 0 else 0)
+        return x
+    observed = [x for x, _ in read_ahead(f, range(4), 4, ordered = False)]
+    assert sorted(observed) == [0, 1, 2, 3]
+    assert observed[-1] == 0
+
+def test_read_ahead_window():
+    lock = threading.Lock()
+    state = {'running': 0, 'max': 0}
+    def f(x):
+        with lock:
+            state['running'] += 1
+            state['max'] = max(state['max'], state['running'])
+        time.sleep(0.01)
+        with lock:
+            state['running'] -= 1
+        return x
+    assert len(list(read_ahead(f, range(20), 3, workers = 8))) == 20
+    assert state['max'] <= 3
+
+def test_read_ahead_error():
+    def f(x):
+        if x == 2:
+            raise ValueError(x)
+        return x
+    with pytest.raises(ValueError):
+        list(read_ahead(f, range(5), 2))
@@ -1,2 +1,3 @@
 from . import ( magic, base64, tuple, simple, raw, )
 from ._delimit import ( slash, backslash, )
+from ._hash import ( hashed, content_hash, )
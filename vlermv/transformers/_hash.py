@@ -0,0 +1,138 @@
+'''
+Hash keys into fixed-length, fixed-depth paths.
+
+Keys may be arbitrarily large or deeply nested; they get canonicalised to
+bytes and hashed, so every key maps to a path of the same shape.
+(The key cannot be recovered from the path; see ``sidecar``.)
+'''
+import datetime
+import hashlib
+import string
+import struct
+import types
+
+def _sized(tag, data):
+    return tag + struct.pack('>Q', len(data)) + data
+
+def canonicalise(obj):
+    '''
+    Convert an object to bytes deterministically, so that equal keys
+    produce equal bytes regardless of dict and set ordering, and in any
+    process, whatever its ``PYTHONHASHSEED``.
+
+    None, bools, ints, floats, strings, bytes, dates, datetimes, tuples,
+    lists, dicts, sets, classes and functions are converted directly.
+    Other objects are converted by canonicalising what they give to
+    :py:mod:`pickle` (from ``__reduce_ex__``), which is their class and
+    their ``__dict__``, ``__getstate__`` or constructor arguments.
+
+    :raises TypeError: If the object can't be pickled
+    '''
+    # bool before int, because bool is a subclass of int
+    if obj is None:
+        return b'N'
+    elif isinstance(obj, bool):
+        return b'T' if obj else b'F'
+    elif isinstance(obj, int):
+        return _sized(b'i', str(obj).encode('ascii'))
+    elif isinstance(obj, float):
+        return _sized(b'f', repr(obj).encode('ascii'))
+    elif isinstance(obj, str):
+        return _sized(b's', obj.encode('utf-8'))
+    elif isinstance(obj, (bytes, bytearray)):
+        return _sized(b'b', bytes(obj))
+    elif isinstance(obj, datetime.datetime):
+        return _sized(b'D', obj.isoformat().encode('ascii'))
+    elif isinstance(obj, datetime.date):
+        return _sized(b'd', obj.isoformat().encode('ascii'))
+    elif isinstance(obj, tuple):
+        return _sized(b't', b''.join(map(canonicalise, obj)))
+    elif isinstance(obj, list):
+        return _sized(b'l', b''.join(map(canonicalise, obj)))
+    elif isinstance(obj, dict):
+        items = sorted(canonicalise(k) + canonicalise(v) for k, v in obj.items())
+        return _sized(b'm', b''.join(items))
+    elif isinstance(obj, (set, frozenset)):
+        return _sized(b'S', b''.join(sorted(map(canonicalise, obj))))
+    elif isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType)):
+        # Pickled by name
+        return _sized(b'g', _global_name(obj, obj.__qualname__))
+    else:
+        return _sized(b'o', _canonicalise_reduced(obj))
+
+def _global_name(obj, name):
+    return ('%s.%s' % (getattr(obj, '__module__', None), name)).encode('utf-8')
+
+def _canonicalise_reduced(obj):
+    '''
+    Canonicalise the parts of an object's pickle, rather than the pickle,
+    whose bytes depend on the order of the sets and dicts in it.
+    '''
+    try:
+        reduced = obj.__reduce_ex__(2)
+    except Exception as e:
+        raise TypeError('Cannot canonicalise %s: %s' % (type(obj).__name__, e))
+    if isinstance(reduced, str):
+        return _global_name(obj, reduced)
+    func, args, state, listitems, dictitems = (tuple(reduced) + (None,) * 5)[:5]
+    if listitems != None:
+        listitems = list(listitems)
+    if dictitems != None:
+        dictitems = dict(dictitems)
+    return b''.join(map(canonicalise, (func, args, state, listitems, dictitems)))
+
+class Digest(str):
+    '''
+    A hex digest from :py:meth:`hashed.from_path`, as returned by
+    :py:meth:`~vlermv.Vlermv.keys`; passing it back as a key refers to
+    the same file rather than to the hash of the digest.
+    '''
+
+class hashed:
+    '''
+    :param int depth: Number of directory levels above the file
+    :param int width: Number of hex characters in each directory name
+    :param int digest_size: Size of the blake2b digest, in bytes;
+        the file name is the full hex digest.
+    :param bool sidecar: Should a human-readable description of each key
+        be saved next to its value? (It is saved with the ``.key`` suffix.)
+    '''
+    sidecar_suffix = '.key'
+
+    def __init__(self, depth = 2, width = 2, digest_size = 16, sidecar = False):
+        if depth * width > 2 * digest_size:
+            raise ValueError('depth * width must not exceed the hex digest length.')
+        self.depth = depth
+        self.width = width
+        self.digest_size = digest_size
+        self.sidecar = sidecar
+
+    def digest(self, key):
+        return hashlib.blake2b(canonicalise(key), digest_size = self.digest_size).hexdigest()
+
+    def to_path(self, key):
+        if isinstance(key, Digest) and len(key) == 2 * self.digest_size:
+            h = key
+        else:
+            h = self.digest(key)
+        w = self.width
+        return tuple(h[i*w:(i+1)*w] for i in range(self.depth)) + (h,)
+
+    def from_path(self, path):
+        '''
+        Return the hex digest as a :py:class:`Digest`, or None if the path
+        was not made by this transformer (sidecar files, for example).
+        '''
+        if len(path) != self.depth + 1:
+            return None
+        h = path[-1]
+        if len(h) != 2 * self.digest_size or not set(h).issubset(string.hexdigits):
+            return None
+        return Digest(h)
+
+    @staticmethod
+    def describe(key):
+        'Human-readable representation of a key, for the sidecar file'
+        return repr(key) + '\n'
+
+content_hash = hashed()
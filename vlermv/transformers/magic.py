@@ -11,6 +11,8 @@ except ImportError:
 import warnings
 import itertools
 import datetime
+import functools
+import re
 
 # For Python 2 compatibility
 try:
@@ -29,7 +31,53 @@ def cli():
 def from_path(obj):
     return obj
 
+#: How many distinct keys to remember in the :py:func:`to_path` cache
+CACHE_SIZE = 4096
+
+_scalars = {str, int, bool, type(None)}
+
+# Strings without any of these go through urlsplit unchanged.
+_needs_parsing = re.compile(r'[:/\\?#\t\r\n]|^[\x00- ]')
+
 def to_path(index):
+    '''
+    Strings, ints, None, and flat tuples of those are handled by a fast path
+    whose results are cached; everything else goes through :py:func:`parse`.
+    Both produce the same paths.
+    '''
+    t = type(index)
+    if t in _scalars:
+        return _to_path_flat(index)
+    elif t == tuple:
+        for x in index:
+            if type(x) not in _scalars:
+                return _to_path_generic(index)
+        return _to_path_flat(*index)
+    else:
+        return _to_path_generic(index)
+
+def to_paths(indices):
+    'Run :py:func:`to_path` on each of several indices.'
+    return [to_path(index) for index in indices]
+
+@functools.lru_cache(maxsize = CACHE_SIZE, typed = True)
+def _to_path_flat(*items):
+    path = []
+    for item in items:
+        if item is None:
+            continue
+        elif type(item) == str:
+            if item == '':
+                continue
+            elif _needs_parsing.search(item):
+                path.extend(replace_special(parse_partial_text(item)))
+            else:
+                path.append(_special.get(item, item))
+        else:
+            path.append(str(item))
+    return tuple(path)
+
+def _to_path_generic(index):
     if not safe_type(index):
         warnings.warn(UserWarning('You should pass an object with a deterministic order. (probably not a %s)' % type(index).__name__))
 
@@ -0,0 +1,80 @@
+import datetime, os, subprocess, sys, threading
+
+import pytest
+
+from .._hash import canonicalise, hashed, content_hash
+
+def test_to_path_shape():
+    for key in ['a', ('a', 3), 'x' * 100000, (None, {'b': [1, 2]})]:
+        path = content_hash.to_path(key)
+        assert len(path) == 3
+        assert [len(x) for x in path] == [2, 2, 32]
+        assert path[-1].startswith(path[0] + path[1])
+
+def test_deterministic_order():
+    a = {'one': 1, 'two': 2, 'three': {3, 33, 333}}
+    b = {'three': {333, 3, 33}, 'two': 2, 'one': 1}
+    assert content_hash.to_path(a) == content_hash.to_path(b)
+
+testcases_distinct = [
+    (1, True),
+    (1, 1.0),
+    (1, '1'),
+    ('a', b'a'),
+    (('a', 'b'), ('ab',)),
+    ((1, 2), [1, 2]),
+    (datetime.date(2015, 1, 2), (2015, 1, 2)),
+    (None, ''),
+]
+
+@pytest.mark.parametrize('left, right', testcases_distinct)
+def test_distinct(left, right):
+    assert canonicalise(left) != canonicalise(right)
+    assert content_hash.to_path(left) != content_hash.to_path(right)
+
+def test_from_path():
+    path = content_hash.to_path(('a', 8))
+    assert content_hash.from_path(path) == path[-1]
+    assert content_hash.from_path(path[1:]) == None
+    assert content_hash.from_path(path[:-1] + (path[-1] + '.key',)) == None
+
+def test_parameters():
+    h = hashed(depth = 1, width = 3, digest_size = 8)
+    path = h.to_path('abc')
+    assert [len(x) for x in path] == [3, 16]
+
+    with pytest.raises(ValueError):
+        hashed(depth = 5, width = 4, digest_size = 8)
+
+def test_digest_round_trip():
+    path = content_hash.to_path(('a', 8))
+    digest = content_hash.from_path(path)
+    assert content_hash.to_path(digest) == path
+    # A plain string is hashed, even if it looks like a digest.
+    assert content_hash.to_path(str(digest)) != path
+
+class Tagged:
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+
+def test_objects():
+    a = Tagged('a', {'x', 'y', 'z'})
+    assert content_hash.to_path(a) == content_hash.to_path(Tagged('a', {'z', 'y', 'x'}))
+    assert content_hash.to_path(a) != content_hash.to_path(Tagged('a', {'x', 'y'}))
+    assert content_hash.to_path(a) != content_hash.to_path({'name': 'a', 'tags': {'x', 'y', 'z'}})
+
+def test_objects_across_processes():
+    # Sets of strings are ordered differently with different hash seeds.
+    code = 'from vlermv.transformers.test.test_hash import Tagged, content_hash; ' \
+           'print(content_hash.to_path(Tagged("a", {"x", "y", "z", "w"}))[-1])'
+    root = os.path.join(os.path.dirname(__file__), '..', '..', '..')
+    digests = set()
+    for seed in ['1', '2', '3']:
+        env = dict(os.environ, PYTHONHASHSEED = seed)
+        digests.add(subprocess.check_output([sys.executable, '-c', code], env = env, cwd = root))
+    assert len(digests) == 1
+
+def test_unsupported():
+    with pytest.raises(TypeError):
+        content_hash.to_path(threading.Lock())
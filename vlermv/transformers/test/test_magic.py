@@ -88,3 +88,25 @@ def test_warn_unsafe_type(recwarn):
     parse({'one','two','three'})
     w = recwarn.pop(UserWarning)
     assert issubclass(w.category, UserWarning)
+
+equivalence_testcases = [index for index, _ in testcases] + [
+    '', ' leading space', 'trailing space ', '\tabc', 'a\nb', '.', '..', '.tmp',
+    ('.', 'a'), ('a', '.tmp'), 'a:b', '?q', '#f', 'x?y#z', 'a\\.',
+    0, -3, True, False, None, (None,), (1, True, 'x'), ('a', None, ''),
+    tuple(), ('favorite color', 'http://example.com/a?b=c'),
+]
+
+@pytest.mark.parametrize('index', equivalence_testcases)
+def test_fast_path_unchanged(index):
+    from ..magic import _to_path_generic
+    assert to_path(index) == _to_path_generic(index)
+    # Again, from the cache
+    assert to_path(index) == _to_path_generic(index)
+
+def test_cache_typed():
+    assert to_path((1,)) == ('1',)
+    assert to_path((True,)) == ('True',)
+
+def test_to_paths():
+    from ..magic import to_paths
+    assert to_paths(['a/b', ('c', 3)]) == [('a', 'b'), ('c', '3')]